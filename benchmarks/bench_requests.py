@@ -0,0 +1,194 @@
+"""
+Measures per-request latency and memory allocations of
+:class:`flask_webtest.TestApp` compared to raw WSGI calls,
+:class:`flask.testing.FlaskClient` and :class:`webtest.TestApp`,
+using the apps from the test suite.
+
+Run from the repository root::
+
+    python -m benchmarks.bench_requests --output bench.json
+
+Results are written as JSON, one entry per (client, scenario) pair, so that
+they can be compared across releases.
+"""
+import argparse
+import importlib.metadata
+import json
+import platform
+import statistics
+import sys
+import time
+import tracemalloc
+from io import BytesIO
+
+import webtest
+from werkzeug.test import EnvironBuilder
+
+import flask_webtest
+from tests.core import app as core_app
+from tests.core_sqlalchemy import app as sqlalchemy_app, db, User
+
+
+CLIENTS = ('wsgi', 'flask', 'webtest', 'flask_webtest')
+SCENARIOS = ('get', 'form_submit', 'session_transaction', 'db_get')
+FORM = {'quit': 'Quit'}
+
+
+class WSGIClient(object):
+    """Calls the WSGI app directly with prebuilt environs."""
+
+    def __init__(self, app):
+        self.app = app
+        self.environs = {}
+
+    def _call(self, method, path, data=None):
+        key = (method, path)
+        if key not in self.environs:
+            builder = EnvironBuilder(path=path, method=method, data=data)
+            self.environs[key] = (builder.get_environ(), builder.input_stream.getvalue()
+                                  if builder.input_stream else b'')
+        environ, body = self.environs[key]
+        environ = dict(environ, **{'wsgi.input': BytesIO(body)})
+        status = []
+        chunks = self.app(environ, lambda s, headers, exc_info=None: status.append(s))
+        try:
+            b''.join(chunks)
+        finally:
+            if hasattr(chunks, 'close'):
+                chunks.close()
+        return status[0]
+
+    def get(self, path):
+        return self._call('GET', path)
+
+    def post(self, path, data):
+        return self._call('POST', path, data)
+
+
+def make_client(name, app, scoped_db=None):
+    if name == 'wsgi':
+        return WSGIClient(app)
+    if name == 'flask':
+        return app.test_client()
+    if name == 'webtest':
+        return webtest.TestApp(app)
+    if scoped_db is not None:
+        return flask_webtest.TestApp(app, db=scoped_db, use_session_scopes=True)
+    return flask_webtest.TestApp(app)
+
+
+def make_request(client_name, scenario):
+    """Returns a callable performing a single request of `scenario`,
+    or `None` if the client doesn't support it.
+    """
+    if scenario == 'db_get':
+        scoped_db = db if client_name == 'flask_webtest' else None
+        client = make_client(client_name, sqlalchemy_app, scoped_db)
+        return lambda: client.get('/user/1/')
+
+    client = make_client(client_name, core_app)
+    if scenario == 'get':
+        return lambda: client.get('/')
+    if scenario == 'form_submit':
+        if client_name in ('wsgi', 'flask'):
+            return lambda: client.post('/', data=FORM)
+        return lambda: client.post('/', FORM)
+    if scenario == 'session_transaction':
+        if client_name not in ('flask', 'flask_webtest'):
+            return None
+        client.get('/sess/save')
+
+        def transaction():
+            with client.session_transaction() as sess:
+                sess['username'] = 'aromanovich'
+        return transaction
+    raise ValueError('Unknown scenario: %r' % (scenario,))
+
+
+def measure(request, number, repeat):
+    """Returns timing and allocation statistics of `request`."""
+    for _ in range(min(number, 50)):
+        request()
+
+    per_request = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            request()
+        per_request.append((time.perf_counter() - start) / number * 1e6)
+
+    tracemalloc.start()
+    try:
+        start_size, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        for _ in range(number):
+            request()
+        end_size, peak_size = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return {
+        'requests': number * repeat,
+        'min_us': round(min(per_request), 2),
+        'median_us': round(statistics.median(per_request), 2),
+        'mean_us': round(statistics.mean(per_request), 2),
+        'peak_alloc_kb': round((peak_size - start_size) / 1024, 2),
+        'retained_bytes_per_request': round((end_size - start_size) / number, 2),
+    }
+
+
+def versions():
+    rv = {'python': platform.python_version()}
+    for package in ('flask', 'werkzeug', 'webtest', 'flask-webtest', 'sqlalchemy'):
+        try:
+            rv[package] = importlib.metadata.version(package)
+        except importlib.metadata.PackageNotFoundError:
+            rv[package] = None
+    return rv
+
+
+def run(clients=CLIENTS, scenarios=SCENARIOS, number=500, repeat=5):
+    results = []
+    with sqlalchemy_app.app_context():
+        db.create_all()
+        db.session.add(User(id=1, name='Anton'))
+        db.session.commit()
+        try:
+            for scenario in scenarios:
+                for client_name in clients:
+                    request = make_request(client_name, scenario)
+                    if request is None:
+                        continue
+                    stats = measure(request, number, repeat)
+                    results.append(dict(client=client_name, scenario=scenario, **stats))
+        finally:
+            db.session.remove()
+            db.drop_all()
+    return {'versions': versions(), 'number': number, 'repeat': repeat, 'results': results}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--client', action='append', choices=CLIENTS,
+                        help='client to benchmark (default: all)')
+    parser.add_argument('--scenario', action='append', choices=SCENARIOS,
+                        help='scenario to benchmark (default: all)')
+    parser.add_argument('--number', type=int, default=500,
+                        help='requests per repetition (default: %(default)s)')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='repetitions (default: %(default)s)')
+    parser.add_argument('--output', help='file to write JSON results to (default: stdout)')
+    args = parser.parse_args(argv)
+
+    report = run(args.client or CLIENTS, args.scenario or SCENARIOS,
+                 args.number, args.repeat)
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as fo:
+            fo.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
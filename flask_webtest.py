@@ -1,13 +1,45 @@
 # coding: utf-8
+import argparse
+import asyncio
+import atexit
+import base64
+import contextvars
+import copy
+import gc
 import importlib.metadata
+import json
+import math
+import multiprocessing
+import re
+import secrets
+import shutil
+import os.path
+import sys
+import sysconfig
+import tempfile
+import threading
+import time
+import tracemalloc
+import weakref
+from collections import OrderedDict, deque, namedtuple
+from collections.abc import Mapping
 from http import cookiejar
-from copy import copy
-from functools import partial
 from contextlib import contextmanager, nullcontext
-
-from werkzeug.local import LocalStack
-from flask import g, session, get_flashed_messages
-from flask.signals import template_rendered, request_started, request_finished
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import ContextVar
+from functools import partial, wraps
+from io import BytesIO, StringIO
+from time import perf_counter
+from urllib.parse import unquote, urlsplit
+
+import jinja2
+from webob.request import environ_from_url
+from webtest import forms as webtest_forms, lint as webtest_lint, utils as webtest_utils
+import flask
+from flask import request as flask_request, session
+from flask.sessions import SecureCookieSession, SecureCookieSessionInterface, SessionInterface
+from flask.signals import (template_rendered, before_render_template, request_started,
+                           request_finished, message_flashed)
 from webtest import (TestApp as BaseTestApp,
                      TestRequest as BaseTestRequest,
                      TestResponse as BaseTestResponse)
@@ -16,17 +48,62 @@ flask_version = importlib.metadata.version('flask')
 
 try:
     import flask_sqlalchemy
+    import sqlalchemy
 except ImportError:
     flask_sqlalchemy = None
-
-try:
-    # Available starting with Flask 0.10
-    from flask.signals import message_flashed
-except ImportError:
-    message_flashed = None
-
-
-_session_scope_stack = LocalStack()
+    sqlalchemy = None
+
+
+# Innermost :class:`SessionScope` pushed in the current context.
+_session_scope = ContextVar('flask_webtest_session_scope', default=None)
+# Store of the request currently being performed by :meth:`TestApp.do_request`.
+_current_store = ContextVar('flask_webtest_store', default=None)
+# Per-request options passed to :class:`TestApp` request methods.
+_request_options = ContextVar('flask_webtest_request_options', default=None)
+# Tuple of (TestApp, Budget) pairs activated by :meth:`TestApp.budget`.
+_active_budgets = ContextVar('flask_webtest_budgets', default=())
+
+#: Capture nothing: responses have empty `contexts`, `flashes` and `session`.
+CAPTURE_NONE = 'none'
+#: Capture template names (contexts are `None`), flashes and session.
+CAPTURE_NAMES = 'names'
+#: Capture template names and contexts, flashes and session.
+CAPTURE_FULL = 'full'
+CAPTURE_MODES = (CAPTURE_NONE, CAPTURE_NAMES, CAPTURE_FULL)
+
+#: Keep references to template contexts as they were passed to templates.
+CONTEXT_REFERENCE = 'reference'
+#: Keep shallow copies of template contexts.
+CONTEXT_COPY = 'copy'
+#: Keep weak references to context values where possible
+#: (see :class:`WeakContext`).
+CONTEXT_WEAKREF = 'weakref'
+#: Keep only context keys with the type and length of their values
+#: (see :class:`ValueSummary`).
+CONTEXT_SUMMARY = 'summary'
+CONTEXT_CAPTURES = (CONTEXT_REFERENCE, CONTEXT_COPY, CONTEXT_WEAKREF, CONTEXT_SUMMARY)
+
+#: Parse HTML with BeautifulSoup and Python's :mod:`html.parser`
+#: (as :mod:`webtest` does).
+HTML_BS4 = 'bs4'
+#: Parse forms with lxml and `response.html` with BeautifulSoup's lxml
+#: tree builder; requires lxml.
+HTML_LXML = 'lxml'
+HTML_BACKENDS = (HTML_BS4, HTML_LXML)
+
+_missing = object()
+
+# Environ keys that depend on the request URL.
+_URL_ENVIRON_KEYS = ('wsgi.url_scheme', 'SERVER_NAME', 'SERVER_PORT', 'HTTP_HOST',
+                     'PATH_INFO', 'QUERY_STRING')
+
+#: Keyword arguments that :class:`TestApp` request methods accept
+#: in addition to the ones of :class:`webtest.TestApp`.
+REQUEST_OPTIONS = ('capture', 'context_capture', 'max_context_items', 'max_context_bytes',
+                   'record_queries', 'budget', 'trace_memory', 'stream', 'cache')
+
+#: Size above which streamed response bodies are spooled to a temporary file.
+STREAM_SPOOL_SIZE = 1024 * 1024
 
 
 class SessionScope(object):
@@ -36,22 +113,151 @@ class SessionScope(object):
     When popped, removes the current session and swap the value of
     :func:`.scopefunc` to the one that was before.
 
+    Scopes are stored in a :class:`contextvars.ContextVar`, so every thread,
+    asyncio task (and every request performed by :class:`TestApp`) has its own
+    stack of scopes.  Tasks created within a scope inherit it, threads don't:
+    a thread only sees the scope if it runs with a copy of the context
+    (:func:`contextvars.copy_context`), as :meth:`TestApp.batch` workers do.
+
+    A transactional scope, being pushed, begins a transaction.  Sessions
+    created within the scope or scopes pushed within it (such as the scopes
+    of requests performed by :class:`TestApp`) use a connection to each of
+    the app's engines the transaction is begun on, and join the transaction
+    by creating a SAVEPOINT, so their commits only release savepoints.
+    Engines and other sessions are not affected.  When popped, the
+    transaction is rolled back, discarding everything written by these
+    sessions meanwhile::
+
+        def setUp(self):
+            self.scope = SessionScope(db, transactional=True)
+            self.scope.push()
+
+        def tearDown(self):
+            self.scope.pop()
+
+    A transactional scope pushed within another one behaves as a regular
+    scope.  Transactional scopes require SQLAlchemy 2.0 or newer (see
+    :attr:`transactions_supported`).
+
+    All threads share the scope's connections, which can't be used
+    concurrently.  While a transactional scope is active, requests performed
+    by :class:`TestApp` (e.g. by :meth:`TestApp.batch` with `workers` or by
+    :class:`AsyncTestApp`) hold :attr:`transaction_lock` and so run one at
+    a time.  Other threads that use the database meanwhile have to hold it
+    as well.
+
     :param db: :class:`flask_sqlalchemy.SQLAlchemy` instance
+    :param transactional: whether the scope is transactional
     """
-
-    def __init__(self, db):
+    #: Lock serializing the use of transactional scopes' connections.
+    transaction_lock = threading.RLock()
+    #: Whether transactional scopes are supported (SQLAlchemy 2.0 or newer).
+    transactions_supported = bool(sqlalchemy) and int(sqlalchemy.__version__.split('.')[0]) >= 2
+    # Number of transactional scopes currently pushed
+    _transactions = 0
+
+    def __init__(self, db, transactional=False):
         self.db = db
+        self.transactional = transactional
+        self._transaction = None
+        self._parent = None
+        # Session registry keys of the scope by keys of the original
+        # scopefunc, see get_scopefunc
+        self._keys = {}
 
     def push(self):
         """Pushes the session scope."""
-        _session_scope_stack.push(self)
+        if self.transactional and _transactional_scope(self.db) is None:
+            self._begin()
+        self._parent = _session_scope.get()
+        _session_scope.set(self)
 
     def pop(self):
-        """Removes the current session and pops the session scope."""
-        self.db.session.remove()
-        rv = _session_scope_stack.pop()
+        """Removes the scope's sessions and pops the session scope."""
+        self._remove_sessions()
+        rv = _session_scope.get()
         assert rv is self, 'Popped wrong session scope.  (%r instead of %r)' \
             % (rv, self)
+        _session_scope.set(self._parent)
+        self._parent = None
+        self._keys.clear()
+        if self._transaction is not None:
+            self._rollback()
+
+    def _remove_sessions(self):
+        """Closes and removes the sessions of the scope, in all app contexts
+        if `db` uses :func:`get_scopefunc`, the current session otherwise.
+        """
+        registry = self.db.session.registry
+        if not getattr(getattr(registry, 'scopefunc', None), 'session_scope_aware', False):
+            self.db.session.remove()
+            return
+        for key in self._keys.values():
+            session = registry.registry.pop(key, None)
+            if session is not None:
+                session.close()
+
+    def _begin(self):
+        """Begins the outer transaction.  Connections are made on demand,
+        see :meth:`_connection`.
+        """
+        assert self.transactions_supported, \
+            'Transactional session scopes require SQLAlchemy 2.0 or newer.'
+        _install_session_factory(self.db)
+        with self.transaction_lock:
+            # Engine -> (connection, outer transaction, isolation level)
+            self._transaction = {}
+            SessionScope._transactions += 1
+
+    def _create_session(self, session_factory):
+        """Creates a session that joins the outer transaction."""
+        session = session_factory(join_transaction_mode='create_savepoint')
+        get_bind = session.get_bind
+
+        def bound_get_bind(mapper=None, clause=None, bind=None, **kwargs):
+            return self._connection(get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs))
+
+        session.get_bind = bound_get_bind
+        return session
+
+    def _connection(self, engine):
+        """Returns the connection to `engine` the outer transaction is begun on."""
+        if isinstance(engine, sqlalchemy.engine.Connection):
+            return engine
+        with self.transaction_lock:
+            transaction = self._transaction
+            if transaction is None:
+                # The scope is already popped
+                return engine
+            if engine not in transaction:
+                connection = engine.connect()
+                isolation_level = _missing
+                if connection.dialect.driver == 'pysqlite':
+                    # pysqlite does not emit BEGIN itself until DML is executed,
+                    # so releasing the first SAVEPOINT would commit; take over
+                    # transaction control for the lifetime of the scope.
+                    driver_connection = connection.connection.driver_connection
+                    isolation_level = driver_connection.isolation_level
+                    driver_connection.isolation_level = None
+                    outer = connection.begin()
+                    connection.exec_driver_sql('BEGIN')
+                else:
+                    outer = connection.begin()
+                transaction[engine] = (connection, outer, isolation_level)
+            return transaction[engine][0]
+
+    def _rollback(self):
+        """Rolls back the outer transaction and closes its connections."""
+        with self.transaction_lock:
+            transaction, self._transaction = self._transaction, None
+            SessionScope._transactions -= 1
+            # Everything committed within the scope is gone
+            _bump_db_generation()
+            for connection, outer, isolation_level in transaction.values():
+                outer.rollback()
+                if isolation_level is not _missing:
+                    connection.connection.driver_connection.isolation_level = isolation_level
+                connection.close()
 
     def __enter__(self):
         self.push()
@@ -61,70 +267,1357 @@ class SessionScope(object):
         self.pop()
 
 
+def _transactional_scope(db):
+    """Returns the innermost pushed transactional scope of `db` or `None`."""
+    scope = _session_scope.get()
+    while scope is not None:
+        if scope._transaction is not None and scope.db is db:
+            return scope
+        scope = scope._parent
+    return None
+
+
+def _install_session_factory(db):
+    """Makes the registry of `db.session` create sessions that join
+    the outer transaction of the current transactional scope, if any.
+    """
+    registry = db.session.registry
+    session_factory = registry.createfunc
+    if getattr(session_factory, 'session_scope_aware', False):
+        return
+
+    def create_session():
+        scope = _transactional_scope(db)
+        if scope is None:
+            return session_factory()
+        return scope._create_session(session_factory)
+
+    create_session.session_scope_aware = True
+    registry.createfunc = create_session
+
+
+def _default_scopefunc():
+    """Returns the scopefunc Flask-SQLAlchemy scopes sessions by."""
+    assert flask_sqlalchemy, 'Is Flask-SQLAlchemy installed?'
+    try:
+        # Flask-SQLAlchemy 3.0 or newer scopes sessions by app context
+        from flask_sqlalchemy.session import _app_ctx_id
+        return _app_ctx_id
+    except ImportError:
+        pass
+    try:
+        # for flask_sqlalchemy older than 2.2 where the connection_stack
+        # was either the app stack or the request stack
+        return flask_sqlalchemy.connection_stack.__ident_func__
+    except AttributeError:
+        # when flask_sqlalchemy 2.2 or newer, which supports only flask 0.10
+        # or newer, we use app stack
+        from flask import _app_ctx_stack
+        return _app_ctx_stack.__ident_func__
+
+
 def get_scopefunc(original_scopefunc=None):
     """Returns :func:`.SessionScope`-aware `scopefunc` that has to be used
     during testing.
-    """
 
+    Outside session scopes it returns what `original_scopefunc` (by default,
+    the one Flask-SQLAlchemy uses) returns.  Within a scope it returns a key
+    that is created once per scope and value of `original_scopefunc`, so
+    looking up `db.session` doesn't build a key tuple every time.
+    """
     if original_scopefunc is None:
-        assert flask_sqlalchemy, 'Is Flask-SQLAlchemy installed?'
+        original_scopefunc = _default_scopefunc()
+
+    def scopefunc():
+        rv = original_scopefunc()
+        scope = _session_scope.get()
+        if scope is None:
+            return rv
+        key = scope._keys.get(rv)
+        if key is None:
+            key = scope._keys[rv] = (rv, id(scope))
+        return key
+
+    scopefunc.session_scope_aware = True
+    return scopefunc
+
+
+class SignalCapture(object):
+    """Persistent subscription to the Flask signals that :class:`TestApp` uses
+    to collect rendered templates, flashed messages, session data
+    and timings.
+
+    Receivers are connected once and only for signals sent by `app`.  Data is
+    routed into the store of the request currently being performed by the
+    owning :class:`TestApp` (see :meth:`new_store`), so several
+    :class:`TestApp` instances never capture each other's requests.
+
+    Receivers are connected weakly: they are disconnected either explicitly
+    by :meth:`disconnect` or when the capture object is garbage collected.
+
+    :param app: :class:`flask.Flask` instance
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.connected = False
+        self.connect()
+
+    def connect(self):
+        """Connects the receivers to the signals sent by the app."""
+        if self.connected:
+            return
+        request_started.connect(self.set_up, sender=self.app)
+        before_render_template.connect(self.before_render_template, sender=self.app)
+        template_rendered.connect(self.store_rendered_template, sender=self.app)
+        message_flashed.connect(self.store_flashed_message, sender=self.app)
+        request_finished.connect(self.tear_down, sender=self.app)
+        self.connected = True
+
+    def disconnect(self):
+        """Disconnects the receivers."""
+        if not self.connected:
+            return
+        request_started.disconnect(self.set_up, sender=self.app)
+        before_render_template.disconnect(self.before_render_template, sender=self.app)
+        template_rendered.disconnect(self.store_rendered_template, sender=self.app)
+        message_flashed.disconnect(self.store_flashed_message, sender=self.app)
+        request_finished.disconnect(self.tear_down, sender=self.app)
+        self.connected = False
+
+    def new_store(self, mode=CAPTURE_FULL, context_capture=CONTEXT_REFERENCE):
+        """Returns an empty store for a request performed by the owner."""
+        return CaptureStore(self, mode, context_capture)
+
+    def current_store(self):
+        """Returns the store of the request being performed, if it
+        was created by this capture object.
+        """
+        store = _current_store.get()
+        if store is not None and store.capture is self:
+            return store
+        return None
+
+    def set_up(self, app, **extra):
+        store = self.current_store()
+        if store is not None:
+            store.request_started = perf_counter()
+            store.url_rule = flask_request.url_rule
+
+    def before_render_template(self, app, template, context, **extra):
+        store = self.current_store()
+        if store is not None:
+            store.render_starts.append(perf_counter())
+
+    def store_rendered_template(self, app, template, context, **extra):
+        store = self.current_store()
+        if store is not None:
+            start = perf_counter()
+            if store.render_starts:
+                render_start = store.render_starts.pop()
+                store.timings.templates.append((template.name, start - render_start))
+                if store.tracer is not None:
+                    store.tracer.add(template.name, 'template', render_start, start)
+            if store.mode == CAPTURE_NONE:
+                return
+            if store.mode == CAPTURE_NAMES:
+                context = None
+            else:
+                context = capture_context(context, store.context_capture)
+            store.setdefault('contexts', []).append((template.name, context))
+            end = perf_counter()
+            store.timings.capture += end - start
+            if store.tracer is not None:
+                store.tracer.add('capture template', 'capture', start, end)
+
+    def store_flashed_message(self, app, message, category, **extra):
+        store = self.current_store()
+        if store is not None and store.mode != CAPTURE_NONE:
+            start = perf_counter()
+            store.setdefault('flashes', []).append((category, message))
+            if store.tracer is not None:
+                store.tracer.add('capture flash', 'capture', start, perf_counter())
+
+    def tear_down(self, app, response, *args, **extra):
+        store = self.current_store()
+        if store is not None:
+            if store.request_started is not None:
+                store.timings.request = perf_counter() - store.request_started
+            if store.mode == CAPTURE_NONE:
+                return
+            start = perf_counter()
+            # The session is copied lazily, see :attr:`TestResponse.session`
+            store['session'] = session._get_current_object()
+            if store.tracer is not None:
+                store.tracer.add('capture session', 'capture', start, perf_counter())
+
+
+class CaptureStore(dict):
+    """Dictionary that collects data captured during a single request."""
+    __slots__ = ('capture', 'mode', 'context_capture', 'timings', 'request_started',
+                 'render_starts', 'queries', 'tracer', 'url_rule')
+
+    def __init__(self, capture, mode=CAPTURE_FULL, context_capture=CONTEXT_REFERENCE):
+        super(CaptureStore, self).__init__()
+        self.capture = capture
+        self.mode = mode
+        self.context_capture = context_capture
+        self.timings = Timings()
+        self.request_started = None
+        self.render_starts = []
+        # List of :class:`RecordedQuery` if queries are recorded
+        self.queries = None
+        # :class:`TraceRecorder` to add spans to
+        self.tracer = None
+        self.url_rule = None
+
+
+class RecordedQuery(namedtuple('RecordedQuery',
+                               ['statement', 'parameters', 'duration', 'location'])):
+    """SQL statement executed during a request: its text, parameters,
+    duration in seconds and the location (``'path:line in function'``) of
+    the code outside of SQLAlchemy that caused it.
+    """
+    __slots__ = ()
+
+    @property
+    def shape(self):
+        """Statement with literals replaced by placeholders
+        (see :func:`statement_shape`).
+        """
+        return statement_shape(self.statement)
+
+
+_literal_re = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_bind_re = re.compile(r'%\(\w+\)s|%s|(?<!:):(?!:)[A-Za-z_]\w*|\$\d+')
+_placeholders_re = re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)')
+_whitespace_re = re.compile(r'\s+')
+
+
+def statement_shape(statement):
+    """Returns `statement` with whitespace normalized, string and number
+    literals replaced by ``?`` and lists of placeholders collapsed, so that
+    statements that only differ in values have the same shape.
+    """
+    shape = _whitespace_re.sub(' ', statement.strip())
+    shape = _literal_re.sub('?', shape)
+    shape = _bind_re.sub('?', shape)
+    return _placeholders_re.sub('(?)', shape)
+
+
+def repeated_queries(queries, min_count=2):
+    """Groups `queries` (list of :class:`RecordedQuery`) by
+    :func:`statement_shape` and returns list of (shape, queries) tuples
+    for shapes executed at least `min_count` times, most repeated first.
+    Statements repeated within a single request usually indicate
+    an N+1 query problem.
+    """
+    groups = OrderedDict()
+    for query in queries:
+        groups.setdefault(query.shape, []).append(query)
+    rv = [(shape, group) for shape, group in groups.items() if len(group) >= min_count]
+    rv.sort(key=lambda item: len(item[1]), reverse=True)
+    return rv
+
+
+# Modules whose frames are skipped when looking for a query's call site.
+_query_location_skip = ('sqlalchemy', 'flask_sqlalchemy', 'flask_webtest')
+_query_starts_key = 'flask_webtest_query_starts'
+_query_listeners_installed = False
+
+
+def _query_location():
+    frame = sys._getframe(2)
+    while frame is not None:
+        module = frame.f_globals.get('__name__', '')
+        if module.partition('.')[0] not in _query_location_skip:
+            code = frame.f_code
+            return '%s:%i in %s' % (code.co_filename, frame.f_lineno, code.co_name)
+        frame = frame.f_back
+    return None
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    store = _current_store.get()
+    if store is not None and store.queries is not None:
+        conn.info.setdefault(_query_starts_key, []).append(perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    store = _current_store.get()
+    if store is not None and store.queries is not None:
+        starts = conn.info.get(_query_starts_key)
+        if starts:
+            duration = perf_counter() - starts.pop()
+            store.queries.append(
+                RecordedQuery(statement, parameters, duration, _query_location()))
+
+
+def install_query_listeners():
+    """Listens to SQL statements executed by all SQLAlchemy engines, so that
+    they are recorded for requests performed by :class:`TestApp` with
+    `record_queries` enabled.  The listeners are installed once per process
+    and do nothing outside such requests.
+    """
+    global _query_listeners_installed
+    if _query_listeners_installed:
+        return
+    assert sqlalchemy, 'Is SQLAlchemy installed?'
+    sqlalchemy.event.listen(sqlalchemy.engine.Engine, 'before_cursor_execute',
+                            _before_cursor_execute)
+    sqlalchemy.event.listen(sqlalchemy.engine.Engine, 'after_cursor_execute',
+                            _after_cursor_execute)
+    _query_listeners_installed = True
+
+
+_db_generation = 0
+_commit_listeners_installed = False
+_flushed_key = 'flask_webtest_flushed'
+
+
+def db_generation():
+    """Returns the number of SQLAlchemy session commits that wrote something
+    (and of rollbacks of transactional :class:`SessionScope`) so far, once
+    :func:`install_commit_listeners` is called.  A session wrote something if
+    it flushed changes or executed a statement other than a SELECT, such as
+    ``session.execute(insert(User))``.  Writes made through connections
+    outside of sessions are not counted.
+    """
+    return _db_generation
+
+
+def _bump_db_generation():
+    global _db_generation
+    _db_generation += 1
+
+
+def _after_flush(session, flush_context):
+    session.info[_flushed_key] = True
+
+
+def _do_orm_execute(orm_execute_state):
+    # Statements that may write: DML, DDL and textual statements
+    if not orm_execute_state.is_select:
+        orm_execute_state.session.info[_flushed_key] = True
+
+
+def _after_commit(session):
+    if session.info.pop(_flushed_key, False):
+        _bump_db_generation()
+
+
+def _after_rollback(session):
+    session.info.pop(_flushed_key, None)
+
+
+def install_commit_listeners():
+    """Listens to commits of all SQLAlchemy sessions to count them,
+    see :func:`db_generation`.  The listeners are installed once per process.
+    """
+    global _commit_listeners_installed
+    if _commit_listeners_installed:
+        return
+    assert sqlalchemy, 'Is SQLAlchemy installed?'
+    session_class = sqlalchemy.orm.Session
+    sqlalchemy.event.listen(session_class, 'after_flush', _after_flush)
+    sqlalchemy.event.listen(session_class, 'do_orm_execute', _do_orm_execute)
+    sqlalchemy.event.listen(session_class, 'after_commit', _after_commit)
+    sqlalchemy.event.listen(session_class, 'after_rollback', _after_rollback)
+    _commit_listeners_installed = True
+
+
+class AllocationSite(namedtuple('AllocationSite', ['location', 'size', 'count'])):
+    """Line of app code (``'path:line'``), size in bytes and number of
+    memory blocks allocated by it.
+    """
+    __slots__ = ()
+
+
+class MemoryUsage(namedtuple('MemoryUsage', ['peak', 'net', 'top'])):
+    """Memory allocated while a request was handled: peak size and size
+    retained at the end of the request, in bytes, and list of
+    :class:`AllocationSite` that retained the most.  The peak is `None` if
+    the request was traced concurrently with others.
+    """
+    __slots__ = ()
+
+
+# Directories of code that is not attributed allocations, see :func:`app_code_location`.
+_library_paths = tuple(sorted(set(
+    os.path.join(os.path.abspath(path), '')
+    for name, path in sysconfig.get_paths().items()
+    if name in ('stdlib', 'platstdlib', 'purelib', 'platlib')
+))) + (os.path.abspath(__file__),)
+
+
+def app_code_location(traceback):
+    """Returns ``'path:line'`` of the most recent frame of
+    :class:`tracemalloc.Traceback` that belongs to app code, i.e. neither to
+    the standard library, installed packages nor Flask-WebTest.  Falls back
+    to the most recent frame.
+    """
+    for frame in reversed(traceback):
+        if frame.filename.startswith('<'):
+            # frozen modules and generated code
+            continue
+        if not os.path.abspath(frame.filename).startswith(_library_paths):
+            return '%s:%i' % (frame.filename, frame.lineno)
+    frame = traceback[-1]
+    return '%s:%i' % (frame.filename, frame.lineno)
+
+
+# Number of active AllocationTrace blocks, whether they started tracing and
+# how many blocks were entered so far, guarded by _tracemalloc_lock.
+_tracemalloc_lock = threading.Lock()
+_tracemalloc_users = 0
+_tracemalloc_started = False
+_tracemalloc_entries = 0
+
+
+class AllocationTrace(object):
+    """Context manager that measures memory allocated within the block
+    using :mod:`tracemalloc`.  Tracing is started if it isn't already and
+    stopped when the last active trace exits, so traces can be used by
+    concurrent requests.  Memory is traced process-wide though: sizes
+    measured by concurrent traces include each other's allocations, and the
+    peak can only be measured by a trace that didn't overlap with others.
+
+    .. attribute:: peak
+
+        Peak size of memory allocated within the block, in bytes;
+        `None` if another trace was active meanwhile.
+
+    .. attribute:: net
+
+        Size of memory allocated within the block and not freed by its end.
+
+    .. attribute:: top
+
+        If `top_limit` is specified, list of at most `top_limit`
+        :class:`AllocationSite` that retained the most memory at the end of
+        the block (see :func:`app_code_location`).  Taking snapshots is
+        expensive.
+
+    :param top_limit: number of allocation sites to collect
+    :param frames: number of frames to store per allocation if tracing is
+                   started by the trace
+    """
+
+    def __init__(self, top_limit=0, frames=25):
+        self.top_limit = top_limit
+        self.frames = frames
+        self.peak = None
+        self.net = None
+        self.top = None
+        self._start_size = 0
+        self._start_snapshot = None
+        # Value of _tracemalloc_entries after the trace was entered,
+        # None if other traces were active at the time
+        self._entry = None
+
+    def __enter__(self):
+        global _tracemalloc_users, _tracemalloc_started, _tracemalloc_entries
+        with _tracemalloc_lock:
+            if not _tracemalloc_users and not tracemalloc.is_tracing():
+                tracemalloc.start(self.frames if self.top_limit else 1)
+                _tracemalloc_started = True
+            _tracemalloc_users += 1
+            _tracemalloc_entries += 1
+            self._entry = _tracemalloc_entries if _tracemalloc_users == 1 else None
+        if self.top_limit:
+            self._start_snapshot = tracemalloc.take_snapshot()
+        with _tracemalloc_lock:
+            # The peak is shared, only reset it if no other trace uses it
+            if self._overlapped():
+                self._entry = None
+            else:
+                tracemalloc.reset_peak()
+        self._start_size = tracemalloc.get_traced_memory()[0]
+        return self
+
+    def _overlapped(self):
+        return self._entry is None or self._entry != _tracemalloc_entries
+
+    def __exit__(self, exc_type, exc_value, tb):
+        size, peak = tracemalloc.get_traced_memory()
+        with _tracemalloc_lock:
+            overlapped = self._overlapped()
+        self.peak = None if overlapped else peak - self._start_size
+        self.net = size - self._start_size
+        try:
+            if self.top_limit:
+                self.top = self._top_sites(tracemalloc.take_snapshot())
+        finally:
+            self._start_snapshot = None
+            self._release()
+
+    def _release(self):
+        global _tracemalloc_users, _tracemalloc_started
+        with _tracemalloc_lock:
+            _tracemalloc_users -= 1
+            if not _tracemalloc_users and _tracemalloc_started:
+                tracemalloc.stop()
+                _tracemalloc_started = False
+
+    def _top_sites(self, snapshot):
+        sites = {}
+        for diff in snapshot.compare_to(self._start_snapshot, 'traceback'):
+            if diff.size_diff <= 0:
+                continue
+            location = app_code_location(diff.traceback)
+            size, count = sites.get(location, (0, 0))
+            sites[location] = (size + diff.size_diff, count + max(diff.count_diff, 0))
+        top = sorted(sites.items(), key=lambda item: item[1][0], reverse=True)
+        return [AllocationSite(location, size, count)
+                for location, (size, count) in top[:self.top_limit]]
+
+
+class BudgetExceeded(AssertionError):
+    """Raised when a request exceeds its :class:`Budget`."""
+
+
+class Budget(object):
+    """Performance budget of a request performed by :class:`TestApp`.
+    Limits that are `None` are not checked.
+
+    :param max_queries: maximum number of SQL statements executed
+    :param max_ms: maximum wall time of :meth:`TestApp.do_request`,
+                   in milliseconds
+    :param max_alloc_kb: maximum peak size of memory allocated while the app
+                         handles the request (see :class:`AllocationTrace`),
+                         in kibibytes
+    """
+
+    def __init__(self, max_queries=None, max_ms=None, max_alloc_kb=None):
+        self.max_queries = max_queries
+        self.max_ms = max_ms
+        self.max_alloc_kb = max_alloc_kb
+
+    @classmethod
+    def coerce(cls, value):
+        """Returns `value` if it's a :class:`Budget` or `None`, otherwise
+        makes a budget of a dictionary of limits.
+        """
+        if value is None or isinstance(value, cls):
+            return value
+        return cls(**value)
+
+    def check(self, response, alloc_peak=None):
+        """Checks `response` against the budget.
+
+        :param alloc_peak: peak size of memory allocated by the request, in bytes,
+                           `None` if unknown
+        :raises BudgetExceeded: if any limit is exceeded
+        """
+        errors = []
+        if self.max_queries is not None and len(response.queries) > self.max_queries:
+            errors.append('%i queries (max %i)' % (len(response.queries), self.max_queries))
+            errors.extend('\n    %ix %s' % (len(queries), shape)
+                          for shape, queries in response.repeated_queries())
+        total_ms = response.timings.total * 1000
+        if self.max_ms is not None and total_ms > self.max_ms:
+            errors.append('%.1f ms (max %s)' % (total_ms, self.max_ms))
+        if self.max_alloc_kb is not None and alloc_peak is not None \
+                and alloc_peak / 1024 > self.max_alloc_kb:
+            errors.append('%.1f KiB allocated (max %s)' % (alloc_peak / 1024, self.max_alloc_kb))
+        if errors:
+            request = response.request
+            raise BudgetExceeded('%s %s exceeded its budget: %s'
+                                 % (request.method, request.path_qs, '; '.join(errors)))
+
+    def __repr__(self):
+        return '<Budget max_queries=%r max_ms=%r max_alloc_kb=%r>' % (
+            self.max_queries, self.max_ms, self.max_alloc_kb)
+
+
+class TraceRecorder(object):
+    """Records spans of requests performed by :class:`TestApp` instances
+    it's attached to, along with spans of template rendering, capture of
+    templates, flashes and session, :meth:`TestApp.session_transaction` and
+    session scope push and pop, and saves them in the Chrome Trace Event
+    format, viewable in Perfetto or ``chrome://tracing``::
+
+        recorder = TraceRecorder('trace.json')
+        w = TestApp(app, tracer=recorder)
+
+    A recorder can be shared by any number of :class:`TestApp` instances
+    and threads.
+
+    :param path: if specified, the trace is saved to `path` at exit
+    """
+
+    def __init__(self, path=None):
+        self.events = []
+        self.lock = threading.Lock()
+        self.origin = perf_counter()
+        self.pid = os.getpid()
+        if path is not None:
+            atexit.register(self.save, path)
+
+    def attach(self, test_app):
+        """Makes `test_app` record spans to this recorder."""
+        test_app.tracer = self
+        return test_app
+
+    def add(self, name, category, start, end, args=None):
+        """Adds a span that lasted from `start` to `end`
+        (values of :func:`time.perf_counter`).
+        """
+        event = {
+            'name': name,
+            'cat': category,
+            'ph': 'X',
+            'ts': round((start - self.origin) * 1e6, 3),
+            'dur': round((end - start) * 1e6, 3),
+            'pid': self.pid,
+            'tid': threading.get_ident(),
+        }
+        if args:
+            event['args'] = args
+        with self.lock:
+            self.events.append(event)
+
+    @contextmanager
+    def span(self, name, category, args=None):
+        """Adds a span that lasts while the block runs."""
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, category, start, perf_counter(), args)
+
+    def to_json(self):
+        """Returns the trace as a JSON-serializable object."""
+        with self.lock:
+            events = list(self.events)
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def save(self, path):
+        """Saves the trace to `path`."""
+        with open(path, 'w') as fo:
+            json.dump(self.to_json(), fo)
+
+
+def percentile(values, percent):
+    """Returns the nearest-rank `percent` percentile of sorted `values`."""
+    index = max(int(math.ceil(percent / 100.0 * len(values))) - 1, 0)
+    return values[index]
+
+
+class EndpointStats(object):
+    """Statistics of requests to a single endpoint, see :class:`EndpointReport`."""
+
+    def __init__(self, endpoint):
+        #: Endpoint name, `None` for requests that matched no URL rule
+        self.endpoint = endpoint
+        #: Durations of requests, in seconds
+        self.durations = []
+        self.bytes = 0
+        self.queries = 0
+        # Number of requests whose queries were recorded
+        self.queried = 0
+
+    @property
+    def hits(self):
+        return len(self.durations)
+
+    def percentile(self, percent):
+        """Returns the nearest-rank `percent` percentile of durations."""
+        return percentile(sorted(self.durations), percent)
+
+    @property
+    def p50(self):
+        return self.percentile(50)
+
+    @property
+    def p95(self):
+        return self.percentile(95)
+
+    @property
+    def max(self):
+        return max(self.durations)
+
+    @property
+    def mean_bytes(self):
+        return self.bytes / len(self.durations)
+
+    @property
+    def mean_queries(self):
+        """Mean number of queries, `None` if no queries were recorded."""
+        if not self.queried:
+            return None
+        return self.queries / self.queried
+
+    def as_dict(self):
+        return {
+            'endpoint': self.endpoint,
+            'hits': self.hits,
+            'p50': self.p50,
+            'p95': self.p95,
+            'max': self.max,
+            'mean_queries': self.mean_queries,
+            'mean_bytes': self.mean_bytes,
+        }
+
+
+class EndpointReport(object):
+    """Aggregates statistics of requests per URL rule of the app
+    (such as ``GET /user/<int:id>/``) across all :class:`TestApp` instances
+    reporting to it, see :data:`endpoint_report`.
+    """
+
+    def __init__(self):
+        #: Whether :class:`TestApp` instances created without explicit
+        #: `report` report to this instance
+        self.enabled = False
+        #: Dictionary of :class:`EndpointStats` keyed by method and URL rule
+        self.stats = {}
+        self.lock = threading.Lock()
+
+    def enable(self, path=None):
+        """Enables the report and, if `path` is specified, writes it to
+        `path` at exit (see :meth:`write`).
+        """
+        self.enabled = True
+        if path is not None:
+            atexit.register(self.write, path)
+
+    def record(self, method, url_rule, duration, nbytes, queries=None):
+        """Adds a request to the statistics of `url_rule`
+        (a :class:`werkzeug.routing.Rule` or `None`).
+        """
+        if url_rule is None:
+            key, endpoint = '%s <unmatched>' % method, None
+        else:
+            key, endpoint = '%s %s' % (method, url_rule.rule), url_rule.endpoint
+        with self.lock:
+            stats = self.stats.get(key)
+            if stats is None:
+                stats = self.stats[key] = EndpointStats(endpoint)
+            stats.durations.append(duration)
+            stats.bytes += nbytes
+            if queries is not None:
+                stats.queries += queries
+                stats.queried += 1
+
+    def clear(self):
+        with self.lock:
+            self.stats.clear()
+
+    def dump(self):
+        """Returns raw statistics as a JSON-serializable object that can be
+        merged into another report with :meth:`load`.
+        """
+        with self.lock:
+            return {key: [stats.endpoint, stats.durations, stats.bytes, stats.queries,
+                          stats.queried]
+                    for key, stats in self.stats.items()}
+
+    def load(self, data):
+        """Merges statistics returned by :meth:`dump` (of a report in
+        another process, for instance) into this report.
+        """
+        with self.lock:
+            for key, (endpoint, durations, nbytes, queries, queried) in data.items():
+                stats = self.stats.get(key)
+                if stats is None:
+                    stats = self.stats[key] = EndpointStats(endpoint)
+                stats.durations.extend(durations)
+                stats.bytes += nbytes
+                stats.queries += queries
+                stats.queried += queried
+
+    def to_json(self):
+        """Returns the report as a JSON-serializable object."""
+        with self.lock:
+            return {key: stats.as_dict() for key, stats in sorted(self.stats.items())}
+
+    def format_table(self):
+        """Returns the report as a text table, slowest (by p95) first."""
+        with self.lock:
+            items = sorted(self.stats.items(), key=lambda item: -item[1].p95)
+            rows = [(key, str(stats.hits), '%.2f' % (stats.p50 * 1000),
+                     '%.2f' % (stats.p95 * 1000), '%.2f' % (stats.max * 1000),
+                     '-' if stats.mean_queries is None else '%.1f' % stats.mean_queries,
+                     '%i' % stats.mean_bytes)
+                    for key, stats in items]
+        header = ('endpoint', 'hits', 'p50 ms', 'p95 ms', 'max ms', 'queries', 'bytes')
+        widths = [max(len(row[i]) for row in rows + [header]) for i in range(len(header))]
+        lines = []
+        for row in [header] + rows:
+            cells = [row[0].ljust(widths[0])]
+            cells += [cell.rjust(width) for cell, width in zip(row[1:], widths[1:])]
+            lines.append('  '.join(cells).rstrip())
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        """Writes the report to `path`: as JSON if it ends with ``.json``,
+        to standard error if it is ``-`` and as a table otherwise.
+        """
+        if not self.stats:
+            return
+        if path == '-':
+            sys.stderr.write(self.format_table())
+        elif path.endswith('.json'):
+            with open(path, 'w') as fo:
+                json.dump(self.to_json(), fo, indent=2)
+        else:
+            with open(path, 'w') as fo:
+                fo.write(self.format_table())
+
+
+#: Process-wide :class:`EndpointReport`.  Enabled, and written at exit,
+#: if the ``FLASK_WEBTEST_REPORT`` environment variable is set to a path
+#: (see :meth:`EndpointReport.write`).
+endpoint_report = EndpointReport()
+if os.environ.get('FLASK_WEBTEST_REPORT'):
+    endpoint_report.enable(os.environ['FLASK_WEBTEST_REPORT'])
+
+
+class StreamChunk(namedtuple('StreamChunk', ['size', 'time', 'duration'])):
+    """Chunk of a streamed response body: its size, the time it was produced
+    at (since the app was called) and how long the app took to produce it,
+    in seconds.
+    """
+    __slots__ = ()
+
+
+class StreamedBody(object):
+    """Body of a streamed response (see :class:`TestApp`), collected from
+    the app chunk by chunk.  Chunks are kept in memory until their total size
+    exceeds `spool_size`, then in a temporary file.  Iterating yields the
+    chunks as the app produced them, until the body is closed: once the
+    whole body is read (e.g. as `response.body`) or the body is garbage
+    collected.
+
+    .. attribute:: chunks
+
+        List of :class:`StreamChunk`, one per non-empty chunk.
+
+    .. attribute:: ttfb
+
+        Time to first byte: time from calling the app to its first non-empty
+        chunk, in seconds; `None` if the body is empty.
+
+    .. attribute:: size
+
+        Total size of the body.
+    """
+
+    def __init__(self, spool_size=STREAM_SPOOL_SIZE):
+        self.spool_size = spool_size
+        self.file = tempfile.SpooledTemporaryFile(max_size=spool_size)
+        self._finalizer = weakref.finalize(self, self.file.close)
+        self.chunks = []
+        self.ttfb = None
+        self.size = 0
+
+    def collect(self, app_iter, start):
+        """Collects chunks of `app_iter`, timed since `start`
+        (value of :func:`time.perf_counter`), and closes it.
+        """
+        try:
+            previous = perf_counter()
+            for chunk in app_iter:
+                now = perf_counter()
+                if chunk:
+                    if self.ttfb is None:
+                        self.ttfb = now - start
+                    self.file.write(chunk)
+                    self.chunks.append(StreamChunk(len(chunk), now - start, now - previous))
+                    self.size += len(chunk)
+                previous = now
+        finally:
+            if hasattr(app_iter, 'close'):
+                app_iter.close()
+
+    @property
+    def spooled(self):
+        """Whether the body was spooled to a temporary file."""
+        return self.size > self.spool_size
+
+    def __iter__(self):
+        self.file.seek(0)
+        for chunk in self.chunks:
+            yield self.file.read(chunk.size)
+
+    def close(self):
+        """Closes the temporary file, chunk sizes and timings are kept."""
+        self._finalizer()
+
+
+class ResponseCache(object):
+    """Cache of responses to idempotent requests for :class:`TestApp`
+    (see its `response_cache`).  A cached response is returned, as a copy
+    with all captured data, for a request with the same method, URL, values
+    of `headers` and cookies, as long as the state of the app is the same:
+
+    * responses are cached per :func:`db_generation`, so a commit of
+      a session that wrote anything (in a test or in a view, within
+      a :class:`SessionScope` or not) or a rollback of a transactional scope
+      invalidates them; writes through connections outside of sessions
+      have to be reported with :meth:`invalidate` or `state_version`;
+    * with :class:`MemorySessionInterface`, a change of any stored session
+      invalidates them too;
+    * `state_version`, if specified, is called for every request and its
+      result is a part of the key, e.g. a counter of writes to an external
+      store.
+
+    Responses cached for an app are dropped once its state changes.
+    Only use it for responses that depend on nothing else.  `hits` and
+    `misses` count how many requests were served from the cache::
+
+        cache = ResponseCache()
+        w = TestApp(app, db=db, response_cache=cache)
+        w.get('/help/')
+        w.get('/help/')
+        assert cache.stats() == {'hits': 1, 'misses': 1, 'entries': 1}
+
+    :param state_version: callable returning a hashable version of the
+                          app's state
+    :param headers: names of request headers that responses depend on
+    :param methods: methods of requests to cache
+    """
+
+    def __init__(self, state_version=None, headers=('Accept', 'Accept-Language', 'Authorization'),
+                 methods=('GET', 'HEAD')):
+        self.state_version = state_version
+        self.headers = tuple(headers)
+        self.methods = tuple(methods)
+        self.entries = {}
+        # Version of the state (last items of keys) per id of the app
+        self._versions = {}
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        if sqlalchemy is not None:
+            install_commit_listeners()
+
+    def key(self, test_app, req):
+        """Returns the cache key of `req` performed by `test_app`."""
+        headers = req.headers
+        cookies = tuple(sorted((cookie.domain, cookie.path, cookie.name, cookie.value)
+                               for cookie in test_app.cookiejar))
+        return (id(test_app.app), req.method, req.url,
+                tuple(headers.get(name) for name in self.headers),
+                headers.get('Cookie'), cookies, _db_generation,
+                getattr(test_app.app.session_interface, 'generation', None),
+                self.state_version() if self.state_version is not None else None)
+
+    def _drop_stale(self, key):
+        # Responses cached for another version of the state of the app
+        # are never returned again
+        app_id, version = key[0], key[-3:]
+        if self._versions.get(app_id, version) != version:
+            for stale in [k for k in self.entries if k[0] == app_id]:
+                del self.entries[stale]
+        self._versions[app_id] = version
+
+    def get(self, key):
+        """Returns the response cached for `key` or `None`."""
+        with self.lock:
+            self._drop_stale(key)
+            response = self.entries.get(key)
+            if response is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return response
+
+    def put(self, key, response):
+        with self.lock:
+            self._drop_stale(key)
+            self.entries[key] = response
+
+    def invalidate(self):
+        """Removes all cached responses."""
+        with self.lock:
+            self.entries.clear()
+            self._versions.clear()
+
+    def stats(self):
+        """Returns a dictionary with numbers of `hits`, `misses`
+        and `entries`.
+        """
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'entries': len(self.entries)}
+
+
+class Timings(object):
+    """Breakdown of the wall time of a request performed by
+    :class:`TestApp`, in seconds.
+
+    .. attribute:: total
+
+        Time spent in :meth:`TestApp.do_request`.
+
+    .. attribute:: wsgi
+
+        Time spent by WebTest dispatching the request to the app and
+        processing the response.
+
+    .. attribute:: request
 
+        Time from :data:`flask.request_started` to :data:`flask.request_finished`.
+
+    .. attribute:: templates
+
+        List of tuples (template name, rendering time).
+
+    .. attribute:: capture
+
+        Time spent by Flask-WebTest capturing templates, flashes and session.
+
+    .. attribute:: ttfb
+
+        Time to first byte of a streamed response (see :class:`StreamedBody`),
+        `None` for other responses.
+
+    `request` and `templates` are only measured when something is captured
+    (see :data:`CAPTURE_NONE`); `request` is `None` otherwise.
+    """
+    __slots__ = ('total', 'wsgi', 'request', 'templates', 'capture', 'ttfb')
+
+    def __init__(self):
+        self.total = 0.0
+        self.wsgi = 0.0
+        self.request = None
+        self.templates = []
+        self.capture = 0.0
+        self.ttfb = None
+
+    def __repr__(self):
+        return ('<Timings total=%.6f wsgi=%.6f request=%s templates=%r capture=%.6f>'
+                % (self.total, self.wsgi,
+                   'None' if self.request is None else '%.6f' % self.request,
+                   self.templates, self.capture))
+
+
+class ValueSummary(namedtuple('ValueSummary', ['type', 'len'])):
+    """Summary of a template context value: name of its type and its length
+    (`None` if the value has no length).
+    """
+    __slots__ = ()
+
+    @classmethod
+    def of(cls, value):
         try:
-            # for flask_sqlalchemy older than 2.2 where the connection_stack
-            # was either the app stack or the request stack
-            original_scopefunc = flask_sqlalchemy.connection_stack.__ident_func__
-        except AttributeError:
+            length = len(value)
+        except TypeError:
+            length = None
+        return cls(type(value).__name__, length)
+
+
+class WeakContext(Mapping):
+    """Read-only template context that keeps weak references to values
+    that support them and strong references to the rest.  Values that have
+    been garbage collected are returned as `None`.
+    """
+
+    def __init__(self, context):
+        self._items = {}
+        for key, value in context.items():
             try:
-                # when flask_sqlalchemy 2.2 or newer, which supports only flask 0.10
-                # or newer, we use app stack
-                from flask import _app_ctx_stack
-                original_scopefunc = _app_ctx_stack.__ident_func__
-            except (AttributeError, ImportError):
-                # flask 3.0.0 or newer does not export _app_ctx_stack
-                # newer flask does not expose an __ident_func__, use greenlet directly
-                import greenlet
-                original_scopefunc = greenlet.getcurrent
+                self._items[key] = (True, weakref.ref(value))
+            except TypeError:
+                self._items[key] = (False, value)
 
-    def scopefunc():
-        rv = original_scopefunc()
-        sqlalchemy_scope = _session_scope_stack.top
-        if sqlalchemy_scope:
-            rv = (rv, id(sqlalchemy_scope))
-        return rv
+    def __getitem__(self, key):
+        is_ref, value = self._items[key]
+        return value() if is_ref else value
 
-    return scopefunc
+    def __iter__(self):
+        return iter(self._items)
 
+    def __len__(self):
+        return len(self._items)
 
-def store_rendered_template(app, template, context, **extra):
-    g._flask_webtest.setdefault('contexts', []).append((template.name, context))
+    def strong_values(self):
+        """Returns values that are kept by strong references."""
+        return [value for is_ref, value in self._items.values() if not is_ref]
 
+    def __repr__(self):
+        return '<WeakContext %r>' % (dict(self),)
 
-def store_flashed_message(app, message, category, **extra):
-    g._flask_webtest.setdefault('flashes', []).append((category, message))
 
+def capture_context(context, strategy=CONTEXT_REFERENCE):
+    """Returns what :class:`TestApp` keeps of a template `context`,
+    according to `strategy` (one of :data:`CONTEXT_CAPTURES`).
+    """
+    if strategy == CONTEXT_REFERENCE:
+        return context
+    if strategy == CONTEXT_COPY:
+        return dict(context)
+    if strategy == CONTEXT_WEAKREF:
+        return WeakContext(context)
+    if strategy == CONTEXT_SUMMARY:
+        return dict((key, ValueSummary.of(value)) for key, value in context.items())
+    raise ValueError('Unknown context capture strategy: %r' % (strategy,))
+
+
+class ContextBudgetExceeded(AssertionError):
+    """Raised when the template contexts captured for a response
+    exceed `max_context_items` or `max_context_bytes`.
+    """
 
-def set_up(app, *args, **extra):
-    g._flask_webtest = {}
-    if not message_flashed:
-        def _get_flashed_messages(*args, **kwargs):
-            # `get_flashed_messages` removes messages from session,
-            # so we store them in `g._flask_webtest`
-            flashes_to_be_consumed = copy(session.get('_flashes', []))
-            g._flask_webtest.setdefault('flashes', []).extend(flashes_to_be_consumed)
-            return get_flashed_messages(*args, **kwargs)
-        app.jinja_env.globals['get_flashed_messages'] = _get_flashed_messages
 
+def check_context_budget(contexts, max_items=None, max_bytes=None):
+    """Checks that captured `contexts` (list of (template name, context)
+    tuples) retain at most `max_items` values and `max_bytes` bytes.  Sizes
+    are shallow (see :func:`sys.getsizeof`) and only values kept by strong
+    references are counted.
 
-def tear_down(store, app, response, *args, **extra):
-    g._flask_webtest['session'] = dict(session)
-    store.update(g._flask_webtest)
-    del g._flask_webtest
-    if not message_flashed:
-        app.jinja_env.globals['get_flashed_messages'] = get_flashed_messages
+    :raises ContextBudgetExceeded: if the budget is exceeded
+    """
+    items = 0
+    size = 0
+    per_template = []
+    for name, context in contexts:
+        if context is None:
+            continue
+        if isinstance(context, WeakContext):
+            values = context.strong_values()
+        else:
+            values = list(context.values())
+        context_size = sum(sys.getsizeof(value) for value in values)
+        per_template.append((name, len(values), context_size))
+        items += len(values)
+        size += context_size
+
+    errors = []
+    if max_items is not None and items > max_items:
+        errors.append('%i context values retained, budget is %i' % (items, max_items))
+    if max_bytes is not None and size > max_bytes:
+        errors.append('%i bytes retained by context values, budget is %i'
+                      % (size, max_bytes))
+    if errors:
+        details = ''.join('\n  %s: %i values, %i bytes' % entry for entry in per_template)
+        raise ContextBudgetExceeded('Template context budget exceeded: %s.%s'
+                                    % ('; '.join(errors), details))
+
+
+def _accepts_request_options(method):
+    """Makes a :class:`webtest.TestApp` request method accept
+    :data:`REQUEST_OPTIONS`.  The options are made available
+    to :meth:`TestApp.do_request`.
+    """
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        options = {}
+        for name in REQUEST_OPTIONS:
+            if name in kwargs:
+                options[name] = kwargs.pop(name)
+        if not options:
+            return method(self, *args, **kwargs)
+        token = _request_options.set(options)
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            _request_options.reset(token)
+    return wrapper
+
+
+class _ResponseCookieAdapter(object):
+    """Makes :class:`flask.Response` cookies extractable by
+    :class:`http.cookiejar.CookieJar`.
+    """
+
+    def __init__(self, response):
+        self.response = response
+
+    def info(self):
+        return self
+
+    def get_all(self, name, default=None):
+        return self.response.headers.getlist(name) or default
+
+    getheaders = get_all
+
+
+class LxmlForm(webtest_forms.Form):
+    """:class:`webtest.forms.Form` parsed from an lxml element of the page
+    instead of its own BeautifulSoup tree, see :data:`HTML_LXML`.  Fields are
+    built the way :class:`webtest.forms.Form` builds them.
+    """
+
+    _field_tags = ('input', 'select', 'textarea', 'button')
+
+    def __init__(self, response, element):
+        from lxml.html import tostring
+
+        self.response = response
+        self.element = element
+        self.text = tostring(element, encoding='unicode', with_tail=False)
+        attrs = element.attrib
+        self.action = attrs.get('action', '')
+        self.method = attrs.get('method', 'GET')
+        self.id = attrs.get('id')
+        self.enctype = attrs.get('enctype', 'application/x-www-form-urlencoded')
+        self._parse_fields()
+
+    def _field_elements(self):
+        elements = list(self.element.iter(*self._field_tags))
+        if self.id:
+            # Fields associated using the `form` attribute
+            outside = self.element.xpath('//*[@form=$id]', id=self.id)
+            if outside:
+                inside = set(elements)
+                outside = set(outside)
+                root = self.element.getroottree().getroot()
+                elements = [element for element in root.iter(*self._field_tags)
+                            if element in inside or element in outside]
+        return elements
+
+    def _parse_fields(self):
+        fields = OrderedDict()
+        field_order = []
+        field_classes = self.FieldClass.classes
+        for pos, element in enumerate(self._field_elements()):
+            attrs = dict(element.attrib)
+            tag = element.tag
+            name = attrs.pop('name', None)
+
+            if tag == 'textarea':
+                text = element.text or ''
+                # Like browsers, drop the newline right after <textarea>
+                if text.startswith('\r\n'):
+                    text = text[2:]
+                elif text.startswith('\n'):
+                    text = text[1:]
+                attrs['value'] = text
+
+            if tag == 'select':
+                field_type = 'multiple_select' if 'multiple' in attrs else 'select'
+            elif tag == 'button':
+                field_type = 'submit'
+            else:
+                field_type = attrs.get('type', 'text').lower()
+            FieldClass = field_classes.get(field_type, self.FieldClass)
+            for attr in ('form', 'tag', 'pos'):
+                attrs.pop(attr, None)
+
+            if field_type == 'radio' and tag == 'input':
+                field = fields.get(name)
+                if field:
+                    field = field[0]
+                else:
+                    field = FieldClass(self, tag, name, pos, **attrs)
+                    fields.setdefault(name, []).append(field)
+                    field_order.append((name, field))
+                field.options.append((attrs.get('value'), 'checked' in attrs, None))
+                field.optionPositions.append(pos)
+                if 'checked' in attrs:
+                    field.selectedIndex = len(field.options) - 1
+                continue
+            if field_type == 'file' and tag == 'input':
+                attrs.pop('value', None)
+
+            field = FieldClass(self, tag, name, pos, **attrs)
+            fields.setdefault(name, []).append(field)
+            field_order.append((name, field))
+
+            if tag == 'select':
+                for option in element.iter('option'):
+                    text = ''.join(option.itertext())
+                    field.options.append((option.get('value', text),
+                                          'selected' in option.attrib, text.strip()))
+
+        self.field_order = field_order
+        self.fields = fields
+
+
+def _parsed_property(name):
+    """Returns a property caching the value of :class:`webtest.TestResponse`
+    property `name` until the response body changes.
+    """
+    descriptor = BaseTestResponse.__dict__[name]
+    parse = getattr(descriptor, 'func', None) or descriptor.fget
+
+    def get(self):
+        body = self.body
+        parsed = self._parsed
+        if parsed is None:
+            parsed = self._parsed = {}
+        cached = parsed.get(name)
+        if cached is None or cached[0] is not body:
+            cached = parsed[name] = (body, parse(self))
+        return cached[1]
+    get.__name__ = name
+    return property(get, doc='Same as :attr:`webtest.TestResponse.%s`, '
+                             'parsed once.' % name)
 
 
 class TestResponse(BaseTestResponse):
     contexts = {}
+    flashes = []
+    queries = []
+    timings = None
+    memory = None
+    stream = None
+    from_cache = False
+    html_backend = HTML_BS4
+    _session = None
+    _session_source = None
+    _parsed = None
+
+    html = _parsed_property('html')
+    xml = _parsed_property('xml')
+    lxml = _parsed_property('lxml')
+    json = _parsed_property('json')
+    pyquery = _parsed_property('pyquery')
+
+    @property
+    def forms(self):
+        """Same as :attr:`webtest.TestResponse.forms`; parsed with lxml if
+        `html_backend` is :data:`HTML_LXML` and once per response body.
+        """
+        body = self.body
+        parsed = self._parsed
+        if parsed is None:
+            parsed = self._parsed = {}
+        cached = parsed.get('forms')
+        if cached is None or cached[0] is not body:
+            self._parse_forms()
+            cached = parsed['forms'] = (body, self._forms_indexed)
+        return cached[1]
+
+    def _parse_forms(self):
+        if self.html_backend != HTML_LXML:
+            return super(TestResponse, self)._parse_forms()
+        forms_ = self._forms_indexed = {}
+        for i, element in enumerate(self.lxml.iter('form')):
+            form = LxmlForm(self, element)
+            forms_[i] = form
+            if form.id:
+                forms_[form.id] = form
+
+    @property
+    def session(self):
+        """Dictionary that contains session data.  It is copied from the
+        request's session the first time it's accessed.
+        """
+        if self._session is None:
+            self._session = dict(self._session_source or {})
+            self._session_source = None
+        return self._session
+
+    @session.setter
+    def session(self, value):
+        self._session = value
+        self._session_source = None
+
+    def _copy(self, request):
+        """Returns a copy of the response to `request`, see :class:`ResponseCache`."""
+        response = self.copy()
+        response.request = request
+        response.app = self.app
+        response.test_app = self.test_app
+        response._use_unicode = self._use_unicode
+        response.errors = self.errors
+        response.contexts = dict(self.contexts)
+        response.flashes = list(self.flashes)
+        response.session = dict(self.session)
+        return response
 
     def _make_contexts_assertions(self):
         assert self.contexts, 'No templates used to render the response.'
@@ -132,6 +1625,12 @@ class TestResponse(BaseTestResponse):
             ('More than one template used to render the response. '
              'Use `contexts` attribute to access their names and contexts.')
 
+    def repeated_queries(self, min_count=2):
+        """Returns statement shapes executed at least `min_count` times
+        during the request (see :func:`repeated_queries`).
+        """
+        return repeated_queries(self.queries, min_count)
+
     @property
     def context(self):
         self._make_contexts_assertions()
@@ -151,10 +1650,206 @@ class CookieJar(cookiejar.CookieJar):
     """CookieJar that always sets ASCII headers, even if cookies have
     unicode parts such as name, value or path. It is necessary to make
     :meth:`TestApp.session_transaction` work correctly.
+
+    All access to the stored cookies, including iteration, happens under
+    the jar's lock, so it can be shared by requests running in several threads.
     """
     def _cookie_attrs(self, cookies):
         attrs = cookiejar.CookieJar._cookie_attrs(self, cookies)
-        return map(str, attrs)
+        return [str(attr) for attr in attrs]
+
+    def __iter__(self):
+        with self._cookies_lock:
+            cookies = list(cookiejar.deepvalues(self._cookies))
+        return iter(cookies)
+
+    def __len__(self):
+        with self._cookies_lock:
+            return sum(1 for cookie in cookiejar.deepvalues(self._cookies))
+
+
+class IndexedCookieJar(CookieJar):
+    """:class:`CookieJar` for suites that keep many cookies, e.g. for many
+    subdomains.  Cookies are stored by (domain, path, name) as usual; in
+    addition the jar remembers which cookie domains match each request host
+    and caches the rendered `Cookie` header per URL until the jar changes
+    or one of its cookies expires.  It can be passed to :class:`TestApp`
+    as a drop-in replacement::
+
+        w = TestApp(app, cookiejar=IndexedCookieJar())
+
+    At most `max_headers` rendered headers are kept; the oldest one is
+    dropped to make room for a new one, so sweeps over many paths don't grow
+    the cache without bound.  Policies that enable RFC 2965 cookies are not
+    cached.
+    """
+
+    def __init__(self, policy=None, max_headers=1024):
+        super(IndexedCookieJar, self).__init__(policy)
+        self.max_headers = max_headers
+        # (scheme, netloc) -> cookie domains that may be returned to it
+        self._domains_by_host = {}
+        # (scheme, netloc, path) -> value of the Cookie header or None
+        self._headers = {}
+        # The earliest expiration time of stored cookies, None if unknown
+        self._next_expiry = math.inf
+
+    def add_cookie_header(self, request):
+        if self._policy.rfc2965:
+            return super(IndexedCookieJar, self).add_cookie_header(request)
+
+        with self._cookies_lock:
+            self._policy._now = self._now = now = int(time.time())
+            if self._get_next_expiry() <= now:
+                self.clear_expired_cookies()
+
+            scheme, netloc, path = urlsplit(request.get_full_url())[:3]
+            header = self._headers.get((scheme, netloc, path), _missing)
+            if header is _missing:
+                domains = self._domains_by_host.get((scheme, netloc))
+                if domains is None:
+                    domains = [domain for domain in self._cookies
+                               if self._policy.domain_return_ok(domain, request)]
+                    self._domains_by_host[(scheme, netloc)] = domains
+                cookies = []
+                for domain in domains:
+                    cookies.extend(self._cookies_for_domain(domain, request))
+                attrs = self._cookie_attrs(cookies)
+                header = '; '.join(attrs) if attrs else None
+                if len(self._headers) >= self.max_headers:
+                    del self._headers[next(iter(self._headers))]
+                self._headers[(scheme, netloc, path)] = header
+
+        if header is not None and not request.has_header('Cookie'):
+            request.add_unredirected_header('Cookie', header)
+
+    def set_cookie(self, cookie):
+        with self._cookies_lock:
+            if cookie.domain not in self._cookies:
+                self._domains_by_host.clear()
+            self._headers.clear()
+            if cookie.expires is not None and self._next_expiry is not None:
+                self._next_expiry = min(self._next_expiry, cookie.expires)
+            super(IndexedCookieJar, self).set_cookie(cookie)
+
+    def clear(self, domain=None, path=None, name=None):
+        with self._cookies_lock:
+            super(IndexedCookieJar, self).clear(domain, path, name)
+            self._domains_by_host.clear()
+            self._headers.clear()
+            self._next_expiry = None
+
+    def _get_next_expiry(self):
+        if self._next_expiry is None:
+            self._next_expiry = min(
+                (cookie.expires for cookie in cookiejar.deepvalues(self._cookies)
+                 if cookie.expires is not None),
+                default=math.inf)
+        return self._next_expiry
+
+
+class MemorySession(SecureCookieSession):
+    """Session of :class:`MemorySessionInterface`; `sid` is the id sent
+    in the session cookie, `None` until the session is saved for the first time.
+    """
+
+    def __init__(self, initial=None, sid=None):
+        super(MemorySession, self).__init__(initial)
+        self.sid = sid
+
+
+class MemorySessionInterface(SessionInterface):
+    """Server-side session interface for tests that keeps sessions in
+    a process-local dictionary, :attr:`sessions`, keyed by an opaque random id
+    sent in the session cookie.  Session data is neither serialized nor
+    signed, so views, :meth:`TestApp.session_transaction` and
+    `response.session` deal with plain Python values (which don't have to
+    be JSON-serializable) and don't pay for itsdangerous on every request.
+
+    Sessions are deep-copied when they are saved and opened, so, like with
+    cookie sessions, changes of mutable values are only kept if the session
+    is marked as `modified`, and requests never share values.  It's
+    installed on the app by
+    :class:`TestApp` with ``memory_sessions=True``::
+
+        w = TestApp(app, memory_sessions=True)
+        with w.session_transaction() as sess:
+            sess['user_id'] = 1
+        assert w.memory_sessions.sessions
+
+    `generation` is incremented on every change of the stored sessions
+    and is a part of :class:`ResponseCache` keys.  Forked workers
+    (:class:`ForkRunner`) get their own copies of the stored sessions.
+    """
+    session_class = MemorySession
+
+    def __init__(self):
+        self.sessions = {}
+        self.generation = 0
+        self.lock = threading.Lock()
+
+    def _cookie_name(self, app):
+        if hasattr(self, 'get_cookie_name'):
+            return self.get_cookie_name(app)
+        # Flask < 2.2
+        return app.session_cookie_name
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(self._cookie_name(app))
+        data = self.sessions.get(sid) if sid else None
+        if data is None:
+            return self.session_class()
+        return self.session_class(copy.deepcopy(data), sid)
+
+    def save_session(self, app, session, response):
+        name = self._cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+
+        if session.accessed:
+            response.vary.add('Cookie')
+
+        if not session:
+            if session.modified:
+                if session.sid is not None:
+                    with self.lock:
+                        self.sessions.pop(session.sid, None)
+                        self.generation += 1
+                response.delete_cookie(name, domain=domain, path=path)
+                response.vary.add('Cookie')
+            return
+
+        if not self.should_set_cookie(app, session):
+            return
+
+        if session.sid is None:
+            session.sid = secrets.token_urlsafe(16)
+        with self.lock:
+            self.sessions[session.sid] = copy.deepcopy(dict(session))
+            self.generation += 1
+
+        options = {}
+        if hasattr(self, 'get_cookie_partitioned'):
+            options['partitioned'] = self.get_cookie_partitioned(app)
+        response.set_cookie(name, session.sid,
+                            expires=self.get_expiration_time(app, session),
+                            httponly=self.get_cookie_httponly(app),
+                            domain=domain, path=path,
+                            secure=self.get_cookie_secure(app),
+                            samesite=self.get_cookie_samesite(app),
+                            **options)
+        response.vary.add('Cookie')
+
+    def clear(self):
+        """Removes all stored sessions."""
+        with self.lock:
+            self.sessions.clear()
+            self.generation += 1
+
+
+def _restore_session_interface(app, interface, previous):
+    if app.session_interface is interface:
+        app.session_interface = previous
 
 
 class TestApp(BaseTestApp):
@@ -171,14 +1866,33 @@ class TestApp(BaseTestApp):
         List of tuples (category, message) containing messages that were
         flashed during request.
 
-        Note: Fully supported only starting with Flask 0.10. If you use
-        previous version, `flashes` will contain only those messages that
-        were consumed by :func:`flask.get_flashed_messages` template calls.
-
     .. attribute:: session
 
         Dictionary that contains session data.
 
+    .. attribute:: queries
+
+        List of :class:`RecordedQuery` executed during the request.
+        Recorded when `db` is passed, unless `record_queries` is disabled.
+
+    .. attribute:: timings
+
+        :class:`Timings` of the request.
+
+    .. attribute:: memory
+
+        :class:`MemoryUsage` of the request if `trace_memory` is enabled.
+
+    .. attribute:: stream
+
+        :class:`StreamedBody` of the response if it was requested with `stream`.
+
+    What is captured is controlled by `capture`, which can also be passed
+    to any request method to override it for that request::
+
+        w = TestApp(app, capture=CAPTURE_NONE)
+        r = w.get('/', capture=CAPTURE_FULL)
+
     If exactly one template was used to render the response, it's name and context
     can be accessed using `response.template` and `response.context` properties.
 
@@ -186,20 +1900,113 @@ class TestApp(BaseTestApp):
     `extra_environ`, :class:`TestApp` will also set HTTP_HOST to SERVER_NAME
     for all requests to the app.
 
+    Signal receivers are connected once, when :class:`TestApp` is created,
+    and only for signals sent by `app`.  They are disconnected by :meth:`close`
+    or when the instance is garbage collected.
+
+    A :class:`TestApp` can be used by several threads at once: each request
+    captures data into its own store and runs within its own session scope
+    (both are held in context-local storage), and the cookie jar is only
+    accessed under its lock.
+
     :param app: :class:`flask.Flask` instance
     :param db: :class:`flask_sqlalchemy.SQLAlchemy` instance
     :param use_session_scopes: if specified, application performs each request
                                within it's own separate session scope
+    :param capture: one of :data:`CAPTURE_FULL` (default), :data:`CAPTURE_NAMES`
+                    and :data:`CAPTURE_NONE`
+    :param context_capture: what to keep of template contexts, one of
+                            :data:`CONTEXT_REFERENCE` (default),
+                            :data:`CONTEXT_COPY`, :data:`CONTEXT_WEAKREF`
+                            and :data:`CONTEXT_SUMMARY`
+    :param max_context_items: if specified, maximum number of context values
+                              a response may retain
+    :param max_context_bytes: if specified, maximum shallow size of context
+                              values a response may retain;
+                              :exc:`ContextBudgetExceeded` is raised
+                              when either budget is exceeded
+    :param record_queries: whether to record SQL statements executed during
+                           requests; enabled by default if `db` is passed
+    :param trace_memory: whether to trace memory allocated while the app
+                         handles requests using :mod:`tracemalloc`; can be
+                         `True` or number of allocation sites to collect
+                         (10 if `True`)
+    :param tracer: :class:`TraceRecorder` to record spans of requests to
+    :param report: :class:`EndpointReport` to add requests to; by default
+                   :data:`endpoint_report` if it's enabled
+    :param html_backend: how responses parse HTML, :data:`HTML_BS4` (default)
+                         or :data:`HTML_LXML`
+    :param recorder: :class:`TrafficRecorder` to record requests
+                     and responses to
+    :param response_cache: :class:`ResponseCache` to serve idempotent requests
+                           from; requests can bypass it with ``cache=False``
+    :param memory_sessions: whether to install a :class:`MemorySessionInterface`
+                            on `app` (reusing the app's one, if it's already
+                            installed); can also be an instance to install.
+                            The installed interface is available as
+                            :attr:`memory_sessions`, the previous one is
+                            restored by :meth:`close` or when the test app
+                            is garbage collected
+
+    Every request method also accepts `budget`, a :class:`Budget` (or
+    a dictionary of its arguments) the request is checked against, see
+    also :meth:`budget`.
+
+    Request methods called with `stream` collect the response body chunk by
+    chunk into `response.stream`, a :class:`StreamedBody`, instead of joining
+    it in memory; `stream` can be `True` or the size above which the body is
+    spooled to a temporary file (:data:`STREAM_SPOOL_SIZE` if `True`)::
+
+        r = w.get('/export.csv', stream=True)
+        assert len(r.stream.chunks) > 1
+        for chunk in r.stream:
+            ...
     """
     RequestClass = TestRequest
 
     def __init__(self, app, db=None, use_session_scopes=False, cookiejar=None,
-                 extra_environ=None, *args, **kwargs):
+                 extra_environ=None, capture=CAPTURE_FULL,
+                 context_capture=CONTEXT_REFERENCE, max_context_items=None,
+                 max_context_bytes=None, record_queries=None, trace_memory=False,
+                 tracer=None, report=None, html_backend=HTML_BS4, recorder=None,
+                 response_cache=None, memory_sessions=False, *args, **kwargs):
         if use_session_scopes:
             assert db, ('`db` (instance of `flask_sqlalchemy.SQLAlchemy`) '
                         'must be passed to use session scopes.')
+        assert capture in CAPTURE_MODES, 'Unknown capture mode: %r' % (capture,)
+        assert context_capture in CONTEXT_CAPTURES, \
+            'Unknown context capture strategy: %r' % (context_capture,)
         self.db = db
         self.use_session_scopes = use_session_scopes
+        self.capture = capture
+        self.context_capture = context_capture
+        self.max_context_items = max_context_items
+        self.max_context_bytes = max_context_bytes
+        if record_queries is None:
+            record_queries = db is not None
+        self.record_queries = record_queries
+        if record_queries:
+            install_query_listeners()
+        self.trace_memory = trace_memory
+        self.tracer = tracer
+        self.report = report
+        assert html_backend in HTML_BACKENDS, 'Unknown HTML backend: %r' % (html_backend,)
+        self.html_backend = html_backend
+        self.recorder = recorder
+        self.response_cache = response_cache
+        self.memory_sessions = None
+        self._session_interface_finalizer = None
+        if memory_sessions:
+            interface = memory_sessions
+            if interface is True:
+                interface = app.session_interface
+                if not isinstance(interface, MemorySessionInterface):
+                    interface = MemorySessionInterface()
+            if app.session_interface is not interface:
+                self._session_interface_finalizer = weakref.finalize(
+                    self, _restore_session_interface, app, interface, app.session_interface)
+                app.session_interface = interface
+            self.memory_sessions = interface
 
         if extra_environ is None:
             extra_environ = {}
@@ -212,41 +2019,339 @@ class TestApp(BaseTestApp):
         # to False in boolan context. That's why we explicitly compare
         # `cookiejar` with None:
         self.cookiejar = CookieJar() if cookiejar is None else cookiejar
+        self.signal_capture = SignalCapture(app)
+
+    get = _accepts_request_options(BaseTestApp.get)
+    post = _accepts_request_options(BaseTestApp.post)
+    put = _accepts_request_options(BaseTestApp.put)
+    patch = _accepts_request_options(BaseTestApp.patch)
+    delete = _accepts_request_options(BaseTestApp.delete)
+    options = _accepts_request_options(BaseTestApp.options)
+    head = _accepts_request_options(BaseTestApp.head)
+    post_json = _accepts_request_options(BaseTestApp.post_json)
+    put_json = _accepts_request_options(BaseTestApp.put_json)
+    patch_json = _accepts_request_options(BaseTestApp.patch_json)
+    delete_json = _accepts_request_options(BaseTestApp.delete_json)
+    request = _accepts_request_options(BaseTestApp.request)
 
-    def do_request(self, *args, **kwargs):
-        store = {}
-        tear_down_ = partial(tear_down, store)
+    @contextmanager
+    def budget(self, budget=None, **limits):
+        """Checks every request performed by this instance within the block
+        against a :class:`Budget`, given either as `budget` or as its
+        keyword arguments::
 
-        request_started.connect(set_up)
-        request_finished.connect(tear_down_)
-        template_rendered.connect(store_rendered_template)
-        if message_flashed:
-            message_flashed.connect(store_flashed_message)
+            with w.budget(max_queries=5, max_ms=50, max_alloc_kb=512):
+                w.get('/users/')
+                w.get('/users/1/')
+
+        A `budget` request option takes precedence over it.
+        """
+        budget = Budget.coerce(budget) or Budget(**limits)
+        token = _active_budgets.set(_active_budgets.get() + ((self, budget),))
+        try:
+            yield budget
+        finally:
+            _active_budgets.reset(token)
+
+    def _get_budget(self, options):
+        if 'budget' in options:
+            return Budget.coerce(options['budget'])
+        for owner, budget in reversed(_active_budgets.get()):
+            if owner is self:
+                return budget
+        return None
+
+    def close(self):
+        """Disconnects signal receivers used to capture request data
+        and restores the session interface replaced by `memory_sessions`.
+        """
+        self.signal_capture.disconnect()
+        if self._session_interface_finalizer is not None:
+            self._session_interface_finalizer()
 
+    def do_request(self, *args, **kwargs):
+        start = perf_counter()
+        options = _request_options.get() or {}
+        capture = options.get('capture', self.capture)
+        assert capture in CAPTURE_MODES, 'Unknown capture mode: %r' % (capture,)
+
+        context_capture = options.get('context_capture', self.context_capture)
+        assert context_capture in CONTEXT_CAPTURES, \
+            'Unknown context capture strategy: %r' % (context_capture,)
+
+        cache = self.response_cache
+        cache_key = None
+        stream = options.get('stream', False)
+        if cache is not None and options.get('cache', True) and not stream:
+            req = args[0] if args else kwargs['req']
+            if req.method in cache.methods:
+                cache_key = cache.key(self, req)
+                cached = cache.get(cache_key)
+                if cached is not None:
+                    return self._cached_response(cached, start, *args, **kwargs)
+
+        budget = self._get_budget(options)
+        record_queries = options.get('record_queries', self.record_queries)
+        if budget is not None and budget.max_queries is not None:
+            record_queries = True
+        if record_queries:
+            install_query_listeners()
+
+        recorder = self.recorder
+        if recorder is not None:
+            # Read before the app consumes wsgi.input
+            request_body = (args[0] if args else kwargs['req']).body
+
+        tracer = self.tracer
+        report = self.report
+        if report is None and endpoint_report.enabled:
+            report = endpoint_report
+        store = None
+        if capture != CAPTURE_NONE or record_queries or tracer is not None or report is not None:
+            store = self.signal_capture.new_store(capture, context_capture)
+            store.tracer = tracer
+            if record_queries:
+                store.queries = []
+        token = _current_store.set(store)
+
+        transaction_lock = None
+        if SessionScope._transactions:
+            # Requests share connections of the transactional scope
+            transaction_lock = SessionScope.transaction_lock
+            transaction_lock.acquire()
         if self.use_session_scopes:
             scope = SessionScope(self.db)
+            scope_start = perf_counter()
             scope.push()
+            if tracer is not None:
+                tracer.add('push session scope', 'db', scope_start, perf_counter())
 
         context = nullcontext
         if self.app.config.get('FLASK_WEBTEST_PUSH_APP_CONTEXT', False):
             context = self.app.app_context
+        allocations = None
+        trace_memory = options.get('trace_memory', self.trace_memory)
+        if trace_memory:
+            allocations = AllocationTrace(10 if trace_memory is True else trace_memory)
+        elif budget is not None and budget.max_alloc_kb is not None:
+            allocations = AllocationTrace()
         try:
-            with context():
-                response = super(TestApp, self).do_request(*args, **kwargs)
+            with context(), allocations or nullcontext():
+                wsgi_start = perf_counter()
+                if stream:
+                    spool_size = STREAM_SPOOL_SIZE if stream is True else stream
+                    response = self._stream_request(*args, spool_size=spool_size, **kwargs)
+                else:
+                    response = super(TestApp, self).do_request(*args, **kwargs)
+                wsgi_end = perf_counter()
         finally:
             if self.use_session_scopes:
+                scope_start = perf_counter()
                 scope.pop()
-            template_rendered.disconnect(store_rendered_template)
-            request_finished.disconnect(tear_down_)
-            request_started.disconnect(set_up)
-            if message_flashed:
-                message_flashed.disconnect(store_flashed_message)
-
-        response.session = store.get('session', {})
-        response.flashes = store.get('flashes', [])
-        response.contexts = dict(store.get('contexts', []))
+                if tracer is not None:
+                    tracer.add('pop session scope', 'db', scope_start, perf_counter())
+            if transaction_lock is not None:
+                transaction_lock.release()
+            _current_store.reset(token)
+
+        timings = Timings() if store is None else store.timings
+        timings.wsgi = wsgi_end - wsgi_start
+        if stream:
+            timings.ttfb = response.stream.ttfb
+        if store is not None and store.queries is not None:
+            response.queries = store.queries
+        if store is not None and capture != CAPTURE_NONE:
+            capture_start = perf_counter()
+            contexts = store.get('contexts', [])
+            max_items = options.get('max_context_items', self.max_context_items)
+            max_bytes = options.get('max_context_bytes', self.max_context_bytes)
+            if max_items is not None or max_bytes is not None:
+                check_context_budget(contexts, max_items, max_bytes)
+            response._session_source = store.get('session')
+            response.flashes = store.get('flashes', [])
+            response.contexts = dict(contexts)
+            capture_end = perf_counter()
+            timings.capture += capture_end - capture_start
+            if tracer is not None:
+                tracer.add('capture response', 'capture', capture_start, capture_end)
+        response.timings = timings
+        if self.html_backend == HTML_LXML:
+            response.html_backend = HTML_LXML
+            response.parser_features = 'lxml'
+        if trace_memory:
+            response.memory = MemoryUsage(allocations.peak, allocations.net, allocations.top)
+        end = perf_counter()
+        timings.total = end - start
+        if tracer is not None:
+            request = response.request
+            tracer.add('%s %s' % (request.method, request.path), 'request', start, end,
+                       {'url': request.url, 'status': response.status_int,
+                        'queries': len(response.queries)})
+        if report is not None:
+            queries = None if store.queries is None else len(store.queries)
+            size = response.stream.size if stream else len(response.body)
+            report.record(response.request.method, store.url_rule, timings.total, size, queries)
+        if recorder is not None:
+            recorder.record(response, request_body)
+        if budget is not None:
+            budget.check(response, allocations and allocations.peak)
+        if cache_key is not None and response.status_int < 500:
+            cache.put(cache_key, response._copy(response.request))
         return response
 
+    def _cached_response(self, cached, start, req, status=None, expect_errors=None):
+        """Returns a copy of `cached` as the response to `req`."""
+        response = cached._copy(req)
+        response.from_cache = True
+        if not expect_errors:
+            self._check_status(status, response)
+            self._check_errors(response)
+        self.cookiejar.extract_cookies(webtest_utils._ResponseCookieAdapter(response),
+                                       webtest_utils._RequestCookieAdapter(req))
+        response.timings = Timings()
+        response.timings.total = perf_counter() - start
+        return response
+
+    def _stream_request(self, req, status=None, expect_errors=None,
+                        spool_size=STREAM_SPOOL_SIZE):
+        """Same as :meth:`webtest.TestApp.do_request`, but collects the body
+        into a :class:`StreamedBody` instead of joining it.
+        """
+        errors = StringIO()
+        req.environ['wsgi.errors'] = errors
+        script_name = req.environ.get('SCRIPT_NAME', '')
+        if script_name and req.path_info.startswith(script_name):
+            req.path_info = req.path_info[len(script_name):]
+        req.environ['paste.testing'] = True
+        req.environ['paste.testing_variables'] = {}
+        self.cookiejar.add_cookie_header(webtest_utils._RequestCookieAdapter(req))
+        app = webtest_lint.middleware(self.app) if self.lint else self.app
+
+        start = perf_counter()
+        status_line, headerlist, app_iter, exc_info = req.call_application(
+            app, catch_exc_info=True)
+        body = StreamedBody(spool_size)
+        body.collect(app_iter, start)
+        res = req.ResponseClass(status=status_line, headerlist=headerlist, app_iter=body)
+        res._use_unicode = self.use_unicode
+        res.request = req
+        res.app = app
+        res.test_app = self
+        res.stream = body
+        res.errors = errors.getvalue()
+        for name, value in req.environ['paste.testing_variables'].items():
+            setattr(res, name, value)
+        if not expect_errors:
+            self._check_status(status, res)
+            self._check_errors(res)
+        self.cookiejar.extract_cookies(webtest_utils._ResponseCookieAdapter(res),
+                                       webtest_utils._RequestCookieAdapter(req))
+        return res
+
+    def batch(self, requests, headers=None, extra_environ=None, status=None,
+              expect_errors=False, workers=None, **options):
+        """Performs `requests` and yields their responses in the same order.
+
+        The base WSGI environ (including `extra_environ` of the instance and of
+        this call, and `headers`) is built once; for every request only the
+        method, path, query string, body and request's own headers and
+        environ are overlaid on its copy.
+
+        A request is either a URL to GET or a dictionary with `url` and
+        optionally `method`, `params`, `json`, `headers`, `extra_environ`,
+        `content_type`, `status`, `expect_errors` and :data:`REQUEST_OPTIONS`::
+
+            specs = [{'url': '/user/%i/' % id, 'capture': CAPTURE_NONE}
+                     for id in ids]
+            for r in w.batch(specs, headers={'Accept': 'application/json'}):
+                assert r.status_int == 200
+
+        `status`, `expect_errors` and `options` are defaults for requests
+        that don't specify them.
+
+        :param workers: if specified, requests are performed by a pool of
+                        `workers` threads, each within a copy of the caller's
+                        context; at most ``2 * workers`` requests are
+                        in flight at any time
+        """
+        perform = self._batch_performer(headers, extra_environ, status, expect_errors, options)
+        if not workers:
+            for spec in requests:
+                yield perform(spec)
+            return
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = deque()
+            for spec in requests:
+                context = contextvars.copy_context()
+                futures.append(pool.submit(context.run, perform, spec))
+                if len(futures) >= 2 * workers:
+                    yield futures.popleft().result()
+            while futures:
+                yield futures.popleft().result()
+
+    def _batch_performer(self, headers, extra_environ, status, expect_errors, options):
+        """Returns a function performing a single :meth:`batch` request spec."""
+        environ = self.RequestClass.blank('/', self._make_environ(extra_environ)).environ
+        if headers:
+            self.RequestClass(environ).headers.update(headers)
+        defaults = dict(options, status=status, expect_errors=expect_errors)
+        return partial(self._batch_request, environ, defaults)
+
+    def _batch_request(self, base_environ, defaults, spec):
+        """Performs a single :meth:`batch` request."""
+        if isinstance(spec, str):
+            spec = {'url': spec}
+        spec = dict(defaults, **spec)
+        method = spec.get('method', 'GET').upper()
+        url = self._remove_fragment(str(spec['url']))
+        params = spec.get('params')
+        content_type = spec.get('content_type')
+        if 'json' in spec:
+            params = json.dumps(spec['json'], cls=self.JSONEncoder)
+            content_type = content_type or 'application/json'
+
+        body = b''
+        if method in ('GET', 'HEAD', 'OPTIONS') or params is None:
+            if params:
+                url = webtest_utils.build_params(url, params)
+        else:
+            body = webtest_utils.encode_params(params, content_type)
+            if isinstance(body, str):
+                body = body.encode('utf8')
+            if body and content_type is None:
+                content_type = 'application/x-www-form-urlencoded'
+
+        environ = base_environ.copy()
+        if '://' in url:
+            url_environ = environ_from_url(url)
+            for name in _URL_ENVIRON_KEYS:
+                environ[name] = url_environ[name]
+        else:
+            path, _, query = url.partition('?')
+            # WSGI strings are bytes decoded as latin-1
+            environ['PATH_INFO'] = unquote(path, encoding='latin-1')
+            environ['QUERY_STRING'] = query
+        environ['REQUEST_METHOD'] = method
+        environ['wsgi.input'] = BytesIO(body)
+        environ['CONTENT_LENGTH'] = str(len(body))
+        if content_type is not None:
+            environ['CONTENT_TYPE'] = content_type
+        if spec.get('extra_environ'):
+            environ.update(spec['extra_environ'])
+
+        req = self.RequestClass(environ)
+        if spec.get('headers'):
+            req.headers.update(spec['headers'])
+
+        options = dict((name, spec[name]) for name in REQUEST_OPTIONS if name in spec)
+        token = _request_options.set(options)
+        try:
+            return self.do_request(req, status=spec['status'],
+                                   expect_errors=spec['expect_errors'])
+        finally:
+            _request_options.reset(token)
+
     def set_werkzeug_cookie(self, name, value, domain, path):
         """
         As of Werkzeug 2.3.0, cookie implementation was refactored, and cookies
@@ -297,7 +2402,50 @@ class TestApp(BaseTestApp):
             with client.session_transaction() as sess:
                 sess['user_id'] = 1
 
-        Internally it uses :meth:`flask.testing.FlaskClient.session_transaction`.
+        If the app uses :class:`flask.sessions.SecureCookieSessionInterface`
+        (the default) or :class:`MemorySessionInterface`, the session is
+        opened and saved directly through it, using the cookies of
+        :attr:`cookiejar`.  For other session interfaces, including their
+        subclasses (which may rely on a request context),
+        :meth:`flask.testing.FlaskClient.session_transaction` is used.
+        """
+        if type(self.app.session_interface) in (SecureCookieSessionInterface,
+                                                MemorySessionInterface):
+            transaction = self._direct_session_transaction
+        else:
+            transaction = self._client_session_transaction
+        span = nullcontext()
+        if self.tracer is not None:
+            span = self.tracer.span('session_transaction', 'session')
+        with span, transaction() as sess:
+            yield sess
+
+    @contextmanager
+    def _direct_session_transaction(self):
+        """Session transaction that only uses `app.session_interface`
+        and :attr:`cookiejar`.
+        """
+        app = self.app
+        interface = app.session_interface
+        req = self.RequestClass.blank('/', self._make_environ())
+        self.cookiejar.add_cookie_header(webtest_utils._RequestCookieAdapter(req))
+
+        sess = interface.open_session(app, app.request_class(req.environ))
+        if sess is None:
+            raise RuntimeError('Session backend did not open a session.')
+        yield sess
+
+        if interface.is_null_session(sess):
+            return
+        response = app.response_class()
+        interface.save_session(app, sess, response)
+        self.cookiejar.extract_cookies(_ResponseCookieAdapter(response),
+                                       webtest_utils._RequestCookieAdapter(req))
+
+    @contextmanager
+    def _client_session_transaction(self):
+        """Session transaction that uses
+        :meth:`flask.testing.FlaskClient.session_transaction`.
         """
         with self.app.test_client() as client:
             translate_werkzeug_cookie = hasattr(client, 'get_cookie')
@@ -332,3 +2480,681 @@ class TestApp(BaseTestApp):
                     # variable (HTTP_COOKIE), but we use custom CookieJar that is
                     # aware of this oddity and always sets 8-bit headers.
                     self.cookiejar.set_cookie(cookie)
+
+
+def _awaitable(name):
+    """Returns an awaitable version of :class:`TestApp` method `name`."""
+    async def method(self, *args, **kwargs):
+        return await self.arun(getattr(self, name), *args, **kwargs)
+    method.__name__ = 'a%s' % name
+    method.__doc__ = 'Awaitable version of :meth:`TestApp.%s`.' % name
+    return method
+
+
+class AsyncTestApp(TestApp):
+    """:class:`TestApp` for asyncio-driven test suites.  Every request method
+    has an awaitable counterpart prefixed with `a`::
+
+        w = AsyncTestApp(app)
+        r1, r2 = await asyncio.gather(w.aget('/'), w.aget('/user/1/'))
+        assert r1.template == 'index.html'
+
+    Requests run in `executor` threads, each within a copy of the awaiting
+    task's context, so templates, flashes, session data and session scopes
+    are captured per request and never bleed between requests awaited
+    concurrently.
+
+    Flask runs `async def` views using `asgiref`, it has to be installed
+    (``pip install flask[async]``).
+
+    :param executor: :class:`concurrent.futures.Executor` to perform requests
+                     in; the event loop's default executor if not specified
+    """
+
+    def __init__(self, app, *args, executor=None, **kwargs):
+        super(AsyncTestApp, self).__init__(app, *args, **kwargs)
+        self.executor = executor
+
+    async def arun(self, func, *args, **kwargs):
+        """Calls `func` in the executor and returns its result.  Useful
+        for webtest helpers that perform requests, e.g.::
+
+            r = await w.arun(r.form.submit)
+        """
+        loop = asyncio.get_running_loop()
+        context = contextvars.copy_context()
+        return await loop.run_in_executor(
+            self.executor, partial(context.run, func, *args, **kwargs))
+
+    aget = _awaitable('get')
+    apost = _awaitable('post')
+    aput = _awaitable('put')
+    apatch = _awaitable('patch')
+    adelete = _awaitable('delete')
+    aoptions = _awaitable('options')
+    ahead = _awaitable('head')
+    apost_json = _awaitable('post_json')
+    aput_json = _awaitable('put_json')
+    apatch_json = _awaitable('patch_json')
+    adelete_json = _awaitable('delete_json')
+    arequest = _awaitable('request')
+
+
+def warm_app(app, db=None):
+    """Does the work a Flask app usually defers until its first requests:
+    builds the URL map, loads every template into the Jinja cache and, if `db`
+    is passed, configures SQLAlchemy mappers and sorts the metadata's tables.
+    """
+    app.url_map.update()
+    jinja_env = app.jinja_env
+    for name in jinja_env.list_templates():
+        try:
+            jinja_env.get_template(name)
+        except (jinja2.TemplateError, UnicodeDecodeError):
+            # Not a template (a static file or an include with syntax of its own)
+            pass
+    if db is not None:
+        sqlalchemy.orm.configure_mappers()
+        db.metadata.sorted_tables
+
+
+class ForkRunner(object):
+    """Runs functions performing requests in forked worker processes.
+
+    The app is warmed (see :func:`warm_app`) once, in the parent process,
+    and shared with the workers copy-on-write, so workers skip app startup.
+    Every worker gets a fresh :class:`TestApp` (created with `testapp_kwargs`)
+    and cookie jar::
+
+        runner = ForkRunner(app, db=db, workers=8)
+        statuses = runner.map(lambda w, id: w.get('/user/%i/' % id).status_int,
+                              range(1000))
+
+    With `db`, every worker uses a database of its own:
+
+    * an SQLite database file is copied for each worker (and the copy is
+      removed when the worker exits); the app's engine, with all its options,
+      connects to the copy;
+    * an in-memory SQLite database is copied with the worker's memory;
+    * other databases are shared; workers only get their own connection
+      pools, so use `transactional` to roll back what every worker writes.
+
+    Requires :func:`os.fork` (so it's not available on Windows).
+
+    :param app: :class:`flask.Flask` instance
+    :param db: :class:`flask_sqlalchemy.SQLAlchemy` instance
+    :param workers: number of worker processes, the number of CPUs by default
+    :param transactional: whether every worker performs its requests within
+                          a transactional :class:`SessionScope` (requires
+                          SQLAlchemy 2.0)
+    """
+
+    def __init__(self, app, db=None, workers=None, transactional=False, **testapp_kwargs):
+        assert hasattr(os, 'fork'), 'ForkRunner requires os.fork.'
+        self.app = app
+        self.db = db
+        self.workers = workers or os.cpu_count() or 1
+        self.transactional = transactional
+        self.testapp_kwargs = testapp_kwargs
+        if db is not None:
+            testapp_kwargs.setdefault('db', db)
+            testapp_kwargs.setdefault('use_session_scopes', True)
+        warm_app(app, db)
+
+    def map(self, func, items):
+        """Calls ``func(test_app, item)`` for every item in worker processes
+        and returns the results (which have to be picklable) in order.  If
+        any of the calls raises, the first exception is re-raised once all
+        workers are done.
+        """
+        items = list(items)
+        workers = max(min(self.workers, len(items)), 1)
+        context = multiprocessing.get_context('fork')
+        processes = []
+        # Objects created so far are never collected in workers,
+        # so collections don't touch (and copy) their memory pages
+        gc.freeze()
+        try:
+            for worker in range(workers):
+                receiver, sender = context.Pipe(duplex=False)
+                process = context.Process(
+                    target=self._work, args=(worker, sender, func, items[worker::workers]))
+                process.start()
+                sender.close()
+                processes.append((process, receiver))
+        finally:
+            gc.unfreeze()
+
+        results = [None] * len(items)
+        error = None
+        for worker, (process, receiver) in enumerate(processes):
+            try:
+                outcomes, report = receiver.recv()
+            except EOFError:
+                outcomes, report = [], None
+            process.join()
+            if process.exitcode and error is None:
+                error = RuntimeError('ForkRunner worker %i exited with code %i.'
+                                     % (worker, process.exitcode))
+            for index, (ok, value) in enumerate(outcomes):
+                if not ok and error is None:
+                    error = value
+                results[worker + index * workers] = value
+            if report:
+                endpoint_report.load(report)
+        if error is not None:
+            raise error
+        return results
+
+    def _work(self, worker, sender, func, items):
+        """Performs `items` in worker process `worker`."""
+        endpoint_report.clear()
+        with self.app.app_context():
+            copies = self._isolate_database(worker)
+            try:
+                scope = None
+                if self.transactional:
+                    scope = SessionScope(self.db, transactional=True)
+                    scope.push()
+                test_app = TestApp(self.app, **self.testapp_kwargs)
+                outcomes = []
+                for item in items:
+                    try:
+                        outcomes.append((True, func(test_app, item)))
+                    except Exception as e:
+                        outcomes.append((False, e))
+                if scope is not None:
+                    scope.pop()
+            finally:
+                for path in copies:
+                    os.remove(path)
+        report = endpoint_report.dump() if endpoint_report.enabled else None
+        try:
+            sender.send((outcomes, report))
+        except Exception as e:
+            error = TypeError('Results of ForkRunner have to be picklable: %s' % e)
+            sender.send(([(False, error)] * len(outcomes), report))
+        sender.close()
+
+    def _isolate_database(self, worker):
+        """Makes the worker use a database of its own, see :class:`ForkRunner`,
+        and returns paths of the database files copied.
+        """
+        if self.db is None:
+            return []
+        copies = []
+        for engine in self._engines():
+            url = engine.url
+            if url.get_backend_name() == 'sqlite':
+                database = url.database
+                if not database or database == ':memory:' or url.query.get('mode') == 'memory':
+                    continue
+                path = '%s.worker%i' % (database, worker)
+                shutil.copyfile(database, path)
+                copies.append(path)
+                # Keep the engine, with all its options, and only make it
+                # connect to the copy
+                connect_args = engine.dialect.create_connect_args(url.set(database=path))[0]
+                sqlalchemy.event.listen(engine, 'do_connect',
+                                        partial(_replace_connect_args, connect_args))
+            # Connections of the parent's pool must not be used by workers
+            engine.dispose(close=False)
+        return copies
+
+    def _engines(self):
+        """Returns engines of all binds of :attr:`db`."""
+        db = self.db
+        if hasattr(type(db), 'engines'):
+            return list(db.engines.values())
+        # Flask-SQLAlchemy 2.x
+        binds = [None] + list(self.app.config.get('SQLALCHEMY_BINDS') or ())
+        return [db.get_engine(self.app, bind) for bind in binds]
+
+
+def _replace_connect_args(connect_args, dialect, connection_record, cargs, cparams):
+    cargs[:] = connect_args
+
+
+class LoadResult(object):
+    """Result of :func:`run_load`.
+
+    .. attribute:: latencies
+
+        Sorted list of request latencies, in seconds.
+
+    .. attribute:: errors
+
+        Number of requests that raised or got a 4xx or 5xx response.
+
+    .. attribute:: duration
+
+        Wall time of the run, in seconds.
+    """
+
+    def __init__(self, latencies, errors, duration):
+        self.latencies = sorted(latencies)
+        self.errors = errors
+        self.duration = duration
+
+    @property
+    def requests(self):
+        return len(self.latencies)
+
+    @property
+    def throughput(self):
+        """Requests per second."""
+        return self.requests / self.duration if self.duration else 0.0
+
+    def percentile(self, percent):
+        """Returns the nearest-rank `percent` percentile of latencies."""
+        return percentile(self.latencies, percent) if self.latencies else None
+
+    def as_dict(self):
+        rv = {
+            'requests': self.requests,
+            'errors': self.errors,
+            'duration': self.duration,
+            'throughput': self.throughput,
+        }
+        for percent in (50, 90, 95, 99, 100):
+            rv['p%i' % percent] = self.percentile(percent)
+        return rv
+
+    def format(self):
+        """Returns the result as text."""
+        lines = [
+            'requests    %i' % self.requests,
+            'errors      %i' % self.errors,
+            'duration    %.3f s' % self.duration,
+            'throughput  %.1f req/s' % self.throughput,
+        ]
+        if self.latencies:
+            for percent in (50, 90, 95, 99, 100):
+                name = 'max' if percent == 100 else 'p%i' % percent
+                lines.append('%-11s %.3f ms' % (name, self.percentile(percent) * 1000))
+        return '\n'.join(lines) + '\n'
+
+
+def _run_load_worker(test_app, scenario, options, share):
+    """Performs requests of `scenario` over and over until `share`, a number
+    of requests or a ``('until', deadline)`` pair, is exhausted.
+    """
+    perform = test_app._batch_performer(options.get('headers'), None, None, True,
+                                        {'capture': CAPTURE_NONE, 'record_queries': False})
+    # Statuses of requests that specify `status` are checked instead
+    scenario = [(dict({'expect_errors': False}, **spec), False)
+                if isinstance(spec, dict) and 'status' in spec else (spec, True)
+                for spec in scenario]
+    latencies = []
+    errors = 0
+    deadline = share[1] if isinstance(share, tuple) else None
+    count = 0
+    while True:
+        for spec, check_status in scenario:
+            if deadline is None:
+                if count >= share:
+                    return latencies, errors
+            elif perf_counter() >= deadline:
+                return latencies, errors
+            count += 1
+            start = perf_counter()
+            try:
+                if perform(spec).status_int >= 400 and check_status:
+                    errors += 1
+            except Exception:
+                errors += 1
+            latencies.append(perf_counter() - start)
+
+
+def run_load(app, scenario, requests=None, duration=None, workers=1, processes=False,
+             db=None, headers=None, **testapp_kwargs):
+    """Performs requests of `scenario` over and over using `workers` threads
+    (or, with `processes`, processes forked by :class:`ForkRunner`) for
+    `duration` seconds or until `requests` requests are performed, and
+    returns a :class:`LoadResult`.  By default, every worker goes through
+    the scenario once.
+
+    Every worker has a :class:`TestApp` of its own, so it keeps its own
+    cookies and session like a single user would.  Nothing is captured
+    and queries are not recorded.
+
+    :param scenario: list of requests in the format of :meth:`TestApp.batch`;
+                     responses with 4xx and 5xx statuses are counted as
+                     errors unless a request specifies `status`
+    :param db: :class:`flask_sqlalchemy.SQLAlchemy` instance; with `db`,
+               every request is performed within its own session scope
+    :param headers: headers to send with every request
+    :param testapp_kwargs: arguments of :class:`TestApp`
+    """
+    scenario = list(scenario)
+    assert scenario, 'Scenario is empty.'
+    start = perf_counter()
+    if duration is not None:
+        shares = [('until', start + duration)] * workers
+    else:
+        if requests is None:
+            requests = len(scenario) * workers
+        shares = [requests // workers + (worker < requests % workers)
+                  for worker in range(workers)]
+    testapp_kwargs['capture'] = CAPTURE_NONE
+    testapp_kwargs['record_queries'] = False
+    work = partial(_run_load_worker, scenario=scenario, options={'headers': headers})
+
+    if processes:
+        runner = ForkRunner(app, db=db, workers=workers, **testapp_kwargs)
+        if duration is not None:
+            # Don't count the time spent warming the app up
+            start = perf_counter()
+            shares = [('until', start + duration)] * workers
+        results = runner.map(lambda test_app, share: work(test_app, share=share), shares)
+    else:
+        if db is not None:
+            testapp_kwargs.setdefault('db', db)
+            testapp_kwargs.setdefault('use_session_scopes', True)
+
+        def run(share):
+            return work(TestApp(app, **testapp_kwargs), share=share)
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(run, shares))
+    duration = perf_counter() - start
+
+    latencies = []
+    errors = 0
+    for worker_latencies, worker_errors in results:
+        latencies.extend(worker_latencies)
+        errors += worker_errors
+    return LoadResult(latencies, errors, duration)
+
+
+def _encode_body(record, key, body):
+    """Stores `body` in `record` as text if it is UTF-8, as base64 otherwise."""
+    if not body:
+        return
+    try:
+        record[key] = body.decode('utf-8')
+    except UnicodeDecodeError:
+        record[key + '_base64'] = base64.b64encode(body).decode('ascii')
+
+
+def _decode_body(record, key):
+    if key in record:
+        return record[key].encode('utf-8')
+    if key + '_base64' in record:
+        return base64.b64decode(record[key + '_base64'])
+    return b''
+
+
+class TrafficRecorder(object):
+    """Records requests performed by :class:`TestApp` instances it's attached
+    to, along with their responses, to `path` as JSON lines (one compact
+    object per request), see :func:`replay_traffic`::
+
+        recorder = TrafficRecorder('traffic.jsonl')
+        w = TestApp(app, recorder=recorder)
+
+    Every line has `method`, `url`, `headers` of the request and `status`,
+    `headers` of the response (as `response_headers`), `templates`,
+    `flashes`, `session` and `duration` of the request.  Request and
+    response bodies are stored as `body` and `response_body` if they
+    are UTF-8, and base64-encoded as `body_base64` and
+    `response_body_base64` otherwise.  Empty values are omitted.
+
+    :param path: path of the file to append to
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.file = open(path, 'a')
+
+    def attach(self, test_app):
+        """Makes `test_app` record requests to this recorder."""
+        test_app.recorder = self
+        return test_app
+
+    def record(self, response, request_body=b''):
+        """Records `response` and the request it's a response to."""
+        request = response.request
+        headers = [[name, value] for name, value in request.headers.items()
+                   if name not in ('Content-Length',)]
+        record = {
+            'method': request.method,
+            'url': request.path_qs,
+            'headers': headers,
+            'status': response.status_int,
+            'response_headers': [list(header) for header in response.headerlist],
+            'templates': list(response.contexts),
+            'flashes': [list(flash) for flash in response.flashes],
+            'session': response.session,
+            'duration': response.timings.total,
+        }
+        _encode_body(record, 'body', request_body)
+        _encode_body(record, 'response_body', response.body)
+        record = {key: value for key, value in record.items() if value or value == 0}
+        line = json.dumps(record, separators=(',', ':'), sort_keys=True, default=repr)
+        with self.lock:
+            self.file.write(line + '\n')
+            self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+def read_traffic(path):
+    """Yields records of requests saved by :class:`TrafficRecorder` to `path`."""
+    with open(path) as fo:
+        for line in fo:
+            if line.strip():
+                yield json.loads(line)
+
+
+class ReplayedRequest(object):
+    """Request replayed by :func:`replay_traffic`.
+
+    .. attribute:: record
+
+        Recorded request, see :class:`TrafficRecorder`.
+
+    .. attribute:: response
+
+        :class:`TestResponse` of the replayed request.
+
+    .. attribute:: differences
+
+        List of tuples (field, recorded value, replayed value) of fields that
+        differ: `status`, `body`, `templates`, `flashes` and `session`.
+    """
+
+    def __init__(self, record, response, differences):
+        self.record = record
+        self.response = response
+        self.differences = differences
+
+    @property
+    def recorded_duration(self):
+        return self.record.get('duration')
+
+    @property
+    def duration(self):
+        return self.response.timings.total
+
+    @property
+    def slowdown(self):
+        """Ratio of the replayed request's duration to the recorded one."""
+        if not self.recorded_duration:
+            return None
+        return self.duration / self.recorded_duration
+
+    def __repr__(self):
+        return '<ReplayedRequest %s %s differences=%r>' % (
+            self.record['method'], self.record['url'], [diff[0] for diff in self.differences])
+
+
+class ReplayReport(object):
+    """Result of :func:`replay_traffic`, a list of :class:`ReplayedRequest`."""
+
+    def __init__(self, requests):
+        self.requests = requests
+
+    @property
+    def mismatches(self):
+        """Replayed requests with differences."""
+        return [request for request in self.requests if request.differences]
+
+    def format(self, timings=False):
+        """Returns differences (and, with `timings`, durations) as text."""
+        lines = []
+        for request in self.requests:
+            line = '%s %s' % (request.record['method'], request.record['url'])
+            if timings and request.recorded_duration:
+                line += '  %.3f ms -> %.3f ms (x%.2f)' % (
+                    request.recorded_duration * 1000, request.duration * 1000,
+                    request.slowdown)
+            if request.differences or timings:
+                lines.append(line)
+            for field, recorded, replayed in request.differences:
+                lines.append('    %s: %s != %s' % (field, _shorten(recorded), _shorten(replayed)))
+        lines.append('%i requests replayed, %i with differences'
+                     % (len(self.requests), len(self.mismatches)))
+        return '\n'.join(lines) + '\n'
+
+
+def _shorten(value, limit=80):
+    text = repr(value)
+    return text if len(text) <= limit else text[:limit - 3] + '...'
+
+
+def replay_traffic(app, records, test_app=None, **testapp_kwargs):
+    """Re-issues recorded requests (see :class:`TrafficRecorder`) in order and
+    compares the results with the recorded ones.  Returns a :class:`ReplayReport`.
+
+    Requests are sent with their recorded headers, cookies included, so the
+    cookie jar is cleared before each request.
+
+    :param records: path of a file saved by :class:`TrafficRecorder`
+                    or an iterable of records
+    :param test_app: :class:`TestApp` to use; by default one is created with
+                     `testapp_kwargs`
+    """
+    if isinstance(records, str):
+        records = read_traffic(records)
+    if test_app is None:
+        test_app = TestApp(app, **testapp_kwargs)
+    perform = test_app._batch_performer(None, None, None, True, {})
+    replayed = []
+    for record in records:
+        spec = {
+            'url': record['url'],
+            'method': record['method'],
+            'headers': dict(record.get('headers', ())),
+        }
+        body = _decode_body(record, 'body')
+        if body:
+            spec['params'] = body
+            spec['content_type'] = spec['headers'].get('Content-Type')
+        test_app.cookiejar.clear()
+        response = perform(spec)
+
+        differences = []
+        replayed_record = {
+            'status': response.status_int,
+            'templates': list(response.contexts),
+            'flashes': [list(flash) for flash in response.flashes],
+            # Compared as recorded: values that are not JSON are repr()'ed
+            'session': json.loads(json.dumps(response.session, default=repr)),
+        }
+        for field, value in replayed_record.items():
+            recorded = record.get(field, 0 if field == 'status' else
+                                  {} if field == 'session' else [])
+            if recorded != value:
+                differences.append((field, recorded, value))
+        recorded_body = _decode_body(record, 'response_body')
+        if recorded_body != response.body:
+            differences.append(('body', recorded_body, response.body))
+        replayed.append(ReplayedRequest(record, response, differences))
+    return ReplayReport(replayed)
+
+
+def load_object(path):
+    """Returns the object `path` (``module:attribute``) refers to."""
+    module_name, _, attribute = path.partition(':')
+    obj = importlib.import_module(module_name)
+    for name in filter(None, attribute.split('.')):
+        obj = getattr(obj, name)
+    return obj
+
+
+def load_app(path):
+    """Returns the Flask app `path` (``module:attribute``) refers to,
+    calling it if it is an app factory.
+    """
+    app = load_object(path)
+    if not isinstance(app, flask.Flask):
+        app = app()
+    return app
+
+
+def main(argv=None):
+    """Entry point of the ``flask-webtest`` command."""
+    parser = argparse.ArgumentParser(prog='flask-webtest')
+    commands = parser.add_subparsers(dest='command', metavar='COMMAND')
+    commands.required = True
+
+    load = commands.add_parser('load', help='Perform requests in-process and report '
+                                            'throughput and latency percentiles.')
+    load.add_argument('app', help='app or app factory, as module:attribute')
+    load.add_argument('urls', nargs='*', metavar='url', help='URLs to GET')
+    load.add_argument('--scenario', metavar='FILE',
+                      help='JSON file with a list of requests (see TestApp.batch)')
+    load.add_argument('-n', '--requests', type=int, help='number of requests to perform')
+    load.add_argument('-d', '--duration', type=float, help='number of seconds to run for')
+    load.add_argument('-c', '--workers', type=int, default=1, help='number of workers')
+    load.add_argument('--processes', action='store_true',
+                      help='use forked processes instead of threads')
+    load.add_argument('--db', metavar='OBJECT',
+                      help='flask_sqlalchemy.SQLAlchemy instance, as module:attribute')
+    load.add_argument('-H', '--header', action='append', default=[],
+                      help='header to send, as "Name: value"')
+    load.add_argument('--json', action='store_true', help='print the result as JSON')
+
+    replay = commands.add_parser('replay', help='Replay requests recorded by '
+                                                'TrafficRecorder and report differences.')
+    replay.add_argument('app', help='app or app factory, as module:attribute')
+    replay.add_argument('path', help='file saved by TrafficRecorder')
+    replay.add_argument('--timings', action='store_true',
+                        help='compare durations with the recorded ones')
+
+    args = parser.parse_args(argv)
+    if args.command == 'replay':
+        report = replay_traffic(load_app(args.app), args.path)
+        sys.stdout.write(report.format(timings=args.timings))
+        return 1 if report.mismatches else 0
+
+    scenario = list(args.urls)
+    if args.scenario:
+        with open(args.scenario) as fo:
+            scenario.extend(json.load(fo))
+    if not scenario:
+        parser.error('specify URLs or a scenario')
+    headers = {}
+    for header in args.header:
+        name, colon, value = header.partition(':')
+        if not colon:
+            parser.error('invalid header %r, expected "Name: value"' % header)
+        headers[name.strip()] = value.strip()
+    result = run_load(load_app(args.app), scenario, requests=args.requests,
+                      duration=args.duration, workers=args.workers,
+                      processes=args.processes, headers=headers,
+                      db=load_object(args.db) if args.db else None)
+    if args.json:
+        sys.stdout.write(json.dumps(result.as_dict(), indent=2) + '\n')
+    else:
+        sys.stdout.write(result.format())
+    return 1 if result.errors else 0
+
+
+if __name__ == '__main__':
+    # Use the importable module, the app may import it as well
+    from flask_webtest import main  # noqa: F811
+    sys.exit(main())
@@ -0,0 +1,160 @@
+# coding: utf-8
+"""pytest plugin providing cached Flask-WebTest fixtures.
+
+The app (and the database schema, if a `db` is configured) is built once per
+pytest process -- once per worker with pytest-xdist -- while every test gets
+its own :class:`flask_webtest.TestApp` with an empty cookie jar and runs within
+a transactional :class:`flask_webtest.SessionScope` that is rolled back after
+the test.  Configuration (``pytest.ini``, ``[tool:pytest]`` or
+``[tool.pytest.ini_options]``)::
+
+    [pytest]
+    flask_webtest_app = myproject.app:create_app
+    flask_webtest_db = myproject.models:db
+    flask_webtest_database_uri = sqlite:////tmp/myproject-{worker}.db
+"""
+import os
+
+import pytest
+
+from flask_webtest import TestApp, SessionScope, endpoint_report, load_app, load_object
+
+_REPORT_KEY = 'flask_webtest_report'
+
+
+def worker_id():
+    """Returns the id of the pytest-xdist worker (such as ``gw0``) or
+    ``master`` if tests are not distributed.
+    """
+    return os.environ.get('PYTEST_XDIST_WORKER', 'master')
+
+
+def pytest_addoption(parser):
+    parser.addini('flask_webtest_app',
+                  'Flask app or app factory to test, as module:attribute')
+    parser.addini('flask_webtest_db',
+                  'flask_sqlalchemy.SQLAlchemy instance of the app, as module:attribute')
+    parser.addini('flask_webtest_database_uri',
+                  'Database URI of the app, {worker} is replaced with the xdist worker id; '
+                  'passed as FLASK_SQLALCHEMY_DATABASE_URI environment variable')
+    group = parser.getgroup('flask-webtest')
+    group.addoption('--flask-webtest-report', action='store', nargs='?', const='-',
+                    default=None, metavar='PATH',
+                    help='Report per-endpoint request statistics at the end of the run, '
+                         'to PATH if specified (see flask_webtest.EndpointReport.write).')
+
+
+def _export_database_uri(config):
+    database_uri = config.getini('flask_webtest_database_uri')
+    if database_uri:
+        os.environ['FLASK_SQLALCHEMY_DATABASE_URI'] = database_uri.format(worker=worker_id())
+
+
+def pytest_load_initial_conftests(early_config, parser, args):
+    # Before conftest.py files and test modules import the app
+    _export_database_uri(early_config)
+
+
+def pytest_configure(config):
+    # Again, in case the plugin was registered too late for the hook above
+    _export_database_uri(config)
+    if config.getoption('flask_webtest_report') is not None:
+        endpoint_report.enable()
+
+
+def pytest_sessionfinish(session):
+    workeroutput = getattr(session.config, 'workeroutput', None)
+    if workeroutput is not None and endpoint_report.enabled:
+        # Sent to the xdist controller, see pytest_testnodedown
+        workeroutput[_REPORT_KEY] = endpoint_report.dump()
+
+
+@pytest.hookimpl(optionalhook=True)
+def pytest_testnodedown(node, error):
+    data = getattr(node, 'workeroutput', {}).get(_REPORT_KEY)
+    if data:
+        endpoint_report.load(data)
+
+
+def pytest_terminal_summary(terminalreporter, config):
+    path = config.getoption('flask_webtest_report')
+    if path is None or not endpoint_report.stats:
+        return
+    if path == '-':
+        terminalreporter.write_sep('=', 'flask-webtest endpoint report')
+        terminalreporter.write(endpoint_report.format_table())
+    else:
+        endpoint_report.write(path)
+        terminalreporter.write_line('flask-webtest endpoint report written to %s' % path)
+
+
+@pytest.fixture(scope='session')
+def flask_webtest_worker():
+    """Id of the pytest-xdist worker, ``master`` without xdist."""
+    return worker_id()
+
+
+@pytest.fixture(scope='session')
+def flask_app(pytestconfig):
+    """The app under test, built once per worker from ``flask_webtest_app``.
+
+    If ``flask_webtest_database_uri`` is set, it's formatted with the worker
+    id and exported as ``FLASK_SQLALCHEMY_DATABASE_URI`` when pytest starts,
+    before conftest.py files and test modules are imported, so that apps
+    loading :meth:`flask.Config.from_prefixed_env` use a database of their
+    own in every worker.
+    """
+    path = pytestconfig.getini('flask_webtest_app')
+    if not path:
+        raise pytest.UsageError('Set the flask_webtest_app ini option '
+                                'or override the flask_app fixture.')
+    return load_app(path)
+
+
+@pytest.fixture(scope='session')
+def flask_db(pytestconfig, flask_app):
+    """The app's :class:`flask_sqlalchemy.SQLAlchemy` instance from
+    ``flask_webtest_db`` (`None` if not set).  Tables are created once per
+    worker and dropped at the end of the run.
+    """
+    path = pytestconfig.getini('flask_webtest_db')
+    if not path:
+        yield None
+        return
+    db = load_object(path)
+    with flask_app.app_context():
+        db.create_all()
+    yield db
+    with flask_app.app_context():
+        db.drop_all()
+
+
+@pytest.fixture
+def db_scope(flask_app, flask_db):
+    """Transactional :class:`flask_webtest.SessionScope` pushed within an app
+    context for the duration of the test; everything written during the test
+    is rolled back.  `None` if there is no `flask_db`.
+
+    Transactional scopes require SQLAlchemy 2.0; with older versions a regular
+    scope is pushed instead and tables are recreated after the test.
+    """
+    if flask_db is None:
+        yield None
+        return
+    with flask_app.app_context():
+        transactional = SessionScope.transactions_supported
+        with SessionScope(flask_db, transactional=transactional) as scope:
+            yield scope
+        if not transactional:
+            flask_db.drop_all()
+            flask_db.create_all()
+
+
+@pytest.fixture
+def testapp(flask_app, flask_db, db_scope):
+    """:class:`flask_webtest.TestApp` of `flask_app` with an empty cookie jar,
+    performing every request within its own session scope if there's a `flask_db`.
+    """
+    w = TestApp(flask_app, db=flask_db, use_session_scopes=flask_db is not None)
+    yield w
+    w.close()
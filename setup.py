@@ -30,17 +30,26 @@ setup(
     author='Anton Romanovich',
     author_email='anthony.romanovich@gmail.com',
     include_package_data=True,
-    py_modules=['flask_webtest'],
+    py_modules=['flask_webtest', 'pytest_flask_webtest'],
     zip_safe=False,
     install_requires=[
         'Flask>=1.1.0',
         'WebTest',
         'blinker',
     ],
+    entry_points={
+        'console_scripts': ['flask-webtest = flask_webtest:main'],
+        'pytest11': ['flask_webtest = pytest_flask_webtest'],
+    },
     extras_require={
         'tests': [
+            'asgiref',
             'flask-sqlalchemy',
-            'greenlet',
+            'lxml',
+            'pytest',
+        ],
+        'lxml': [
+            'lxml',
         ],
     },
     classifiers=[
@@ -1,7 +1,11 @@
-from flask import Flask, request, flash, render_template, session
+import asyncio
+
+from flask import (Flask, Response, request, flash, jsonify, render_template, session,
+                   stream_with_context)
 
 
 app = Flask(__name__)
+retained = []
 app.testing = True
 app.config['SECRET_KEY'] = '123'
 app.config['DEBUG'] = '123'
@@ -19,6 +23,32 @@ def home():
         return render_template('template.html', text='Hello!')
 
 
+@app.route('/forms/')
+def forms():
+    return render_template('forms.html')
+
+
+@app.route('/profile/', methods=['POST'])
+def profile():
+    return ', '.join('%s=%s' % item for item in sorted(request.form.items()))
+
+
+@app.route('/json/', methods=['POST'])
+def echo_json():
+    return jsonify(request.get_json())
+
+
+@app.route('/stream/<int:rows>/')
+def stream(rows):
+    session['streamed'] = rows
+
+    def generate():
+        yield ''
+        for i in range(rows):
+            yield '%i,%s\n' % (i, request.args.get('name', ''))
+    return Response(stream_with_context(generate()), mimetype='text/csv')
+
+
 @app.route('/whoami/')
 def whoami():
     return session.get('username', 'nobody')
@@ -33,3 +63,23 @@ def sess(action: str):
     else:
         return session.get('picard', 'riker') + session.get('foo', 'baz')
 
+
+@app.route('/cart/')
+def cart():
+    # Changes the session without marking it as modified
+    session['cart'].append(1)
+    return str(len(session['cart']))
+
+
+@app.route('/async/<int:delay>/')
+async def async_view(delay: int):
+    await asyncio.sleep(delay / 1000)
+    flash('Waited %i ms' % delay)
+    return render_template('template.html', text=str(delay))
+
+
+@app.route('/memory/<int:size>/')
+def memory(size: int):
+    data = ['item %i' % i for i in range(size)]
+    retained.append(data[:size // 10])
+    return str(len(data))
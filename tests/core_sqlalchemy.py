@@ -42,3 +42,22 @@ def preview(id):
     user.greeting = request.form['greeting']
     db.session.expunge(user)
     return user.greet()
+
+
+@app.route('/user/', methods=['POST'])
+def create_user():
+    user = User(name=request.form['name'])
+    db.session.add(user)
+    db.session.commit()
+    return str(user.id)
+
+
+@app.route('/users/')
+def users():
+    return ', '.join(user.name for user in db.session.query(User).order_by(User.id))
+
+
+@app.route('/users/one-by-one/')
+def users_one_by_one():
+    ids = [id for id, in db.session.query(User.id).order_by(User.id)]
+    return ', '.join(db.session.get(User, id).name for id in ids)
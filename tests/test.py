@@ -1,12 +1,54 @@
+import asyncio
+import gc
+import http.cookiejar
+import io
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import textwrap
+import time
+import tracemalloc
 import unittest
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
 
+import flask
 import sqlalchemy
-from flask_webtest import TestApp
+from flask.sessions import SecureCookieSessionInterface, SessionInterface
+from flask.signals import template_rendered
+from webtest import AppError, forms as webtest_forms
+
+try:
+    import lxml
+except ImportError:
+    lxml = None
+try:
+    import asgiref
+except ImportError:
+    asgiref = None
+from flask_webtest import (TestApp, SessionScope, statement_shape, Budget, BudgetExceeded,
+                           AsyncTestApp, IndexedCookieJar, CAPTURE_NONE, CAPTURE_NAMES,
+                           CAPTURE_FULL, CONTEXT_COPY, CONTEXT_WEAKREF, CONTEXT_SUMMARY,
+                           ContextBudgetExceeded, ValueSummary, WeakContext, TraceRecorder,
+                           EndpointReport, ForkRunner, HTML_LXML, LxmlForm,
+                           StreamedBody, run_load, main, TrafficRecorder, replay_traffic,
+                           read_traffic, ResponseCache, MemorySessionInterface,
+                           flask_version, AllocationTrace)
 
 from .core import app as app1
 from .core_sqlalchemy import app as app2, db, User
 
 
+def http_cookie(name, value, domain, path='/', expires=None):
+    return http.cookiejar.Cookie(
+        version=0, name=name, value=value, port=None, port_specified=False,
+        domain=domain, domain_specified=False, domain_initial_dot=False,
+        path=path, path_specified=True, secure=False, expires=expires,
+        discard=False, comment=None, comment_url=None, rest={})
+
+
 class TestMainFeatures(unittest.TestCase):
     def setUp(self):
         self.app = app1
@@ -53,6 +95,135 @@ class TestMainFeatures(unittest.TestCase):
         self.assertEqual(r.session['username'], 'aromanovich')
         self.assertEqual(r.body.decode('utf-8'), 'aromanovich')
 
+    def test_session_transaction_does_not_use_client(self):
+        with mock.patch.object(self.app, 'test_client', side_effect=AssertionError):
+            with self.w.session_transaction() as sess:
+                sess['username'] = 'aromanovich'
+        r = self.w.get('/whoami/')
+        self.assertEqual(r.body.decode('utf-8'), 'aromanovich')
+
+    def test_session_transaction_custom_interface(self):
+        class CustomSessionInterface(SessionInterface):
+            interface = SecureCookieSessionInterface()
+
+            def open_session(self, app, request):
+                return self.interface.open_session(app, request)
+
+            def save_session(self, app, session, response):
+                return self.interface.save_session(app, session, response)
+
+        with mock.patch.object(self.app, 'session_interface', CustomSessionInterface()):
+            self.w.get('/sess/save')
+            with self.w.session_transaction() as sess:
+                sess['picard'] = 'enterprise'
+            r = self.w.get('/sess/get')
+        self.assertEqual(r.text, 'enterprisebar')
+        self.assertEqual(len(self.w.cookiejar), 1)
+
+    def test_memory_sessions(self):
+        original = self.app.session_interface
+        w = TestApp(self.app, memory_sessions=True)
+        store = w.memory_sessions
+        self.assertIsInstance(self.app.session_interface, MemorySessionInterface)
+        self.assertIs(TestApp(self.app, memory_sessions=True).memory_sessions, store)
+        try:
+            w.get('/sess/save')
+            sid, = store.sessions
+            self.assertEqual(w.cookies['session'], sid)
+            with mock.patch('itsdangerous.URLSafeTimedSerializer.dumps',
+                            side_effect=AssertionError):
+                with w.session_transaction() as sess:
+                    self.assertEqual(sess['foo'], 'bar')
+                    sess['picard'] = 'enterprise'
+                    sess['ranks'] = {'captain'}  # Not JSON-serializable
+                r = w.get('/sess/get')
+            self.assertEqual(r.text, 'enterprisebar')
+            self.assertEqual(r.session['ranks'], {'captain'})
+            self.assertEqual(store.sessions, {sid: {'foo': 'bar', 'picard': 'enterprise',
+                                                    'ranks': {'captain'}}})
+
+            other = TestApp(self.app)
+            self.assertEqual(other.get('/sess/get').text, 'rikerbaz')
+            other.set_cookie('session', 'forged')
+            self.assertEqual(other.get('/whoami/').text, 'nobody')
+
+            cache = ResponseCache()
+            cached = TestApp(self.app, cookiejar=w.cookiejar, response_cache=cache)
+            cached.get('/whoami/')
+            self.assertTrue(cached.get('/whoami/').from_cache)
+            with w.session_transaction() as sess:
+                sess['username'] = 'picard'
+            self.assertEqual(cached.get('/whoami/').text, 'picard')
+            self.assertEqual(cache.stats()['hits'], 1)
+
+            # Changes of mutable values are only kept if the session is modified
+            with w.session_transaction() as sess:
+                sess['cart'] = []
+            self.assertEqual(w.get('/cart/').text, '1')
+            self.assertEqual(w.get('/cart/').text, '1')
+            self.assertEqual(store.sessions[sid]['cart'], [])
+
+            with w.session_transaction() as sess:
+                sess.clear()
+            self.assertEqual(store.sessions, {})
+            self.assertEqual(w.get('/sess/get').text, 'rikerbaz')
+        finally:
+            w.close()
+        self.assertIs(self.app.session_interface, original)
+
+        # The session interface is also restored when the test app is collected
+        w = TestApp(self.app, memory_sessions=True)
+        self.assertIsInstance(self.app.session_interface, MemorySessionInterface)
+        del w
+        gc.collect()
+        self.assertIs(self.app.session_interface, original)
+
+    def test_session_transaction_interface_subclass(self):
+        class RequestSessionInterface(SecureCookieSessionInterface):
+            def open_session(self, app, request):
+                assert flask.request.path == request.path
+                return super(RequestSessionInterface, self).open_session(app, request)
+
+        with mock.patch.object(self.app, 'session_interface', RequestSessionInterface()):
+            self.w.get('/sess/save')
+            with self.w.session_transaction() as sess:
+                sess['picard'] = 'enterprise'
+            r = self.w.get('/sess/get')
+        self.assertEqual(r.text, 'enterprisebar')
+
+    def test_indexed_cookiejar(self):
+        w = TestApp(self.app, cookiejar=IndexedCookieJar())
+        w.get('/sess/save')
+        with w.session_transaction() as sess:
+            sess['picard'] = 'enterprise'
+        self.assertEqual(len(w.cookiejar), 1)
+        r = w.get('/sess/get')
+        self.assertEqual(r.text, 'enterprisebar')
+
+        w.cookiejar.clear()
+        for i in range(50):
+            w.cookiejar.set_cookie(http_cookie('tenant', str(i), 'tenant%i.example.com' % i))
+        w.cookiejar.set_cookie(http_cookie('expired', 'x', 'tenant7.example.com',
+                                           expires=int(time.time()) + 60))
+        r = w.get('http://tenant7.example.com/whoami/')
+        self.assertEqual(r.request.headers['Cookie'], 'tenant=7; expired=x')
+
+        with mock.patch('time.time', return_value=time.time() + 120):
+            r = w.get('http://tenant7.example.com/whoami/')
+        self.assertEqual(r.request.headers['Cookie'], 'tenant=7')
+        self.assertEqual(len(w.cookiejar), 50)
+
+        w.cookiejar.clear('tenant7.example.com')
+        r = w.get('http://tenant7.example.com/whoami/')
+        self.assertNotIn('Cookie', r.request.headers)
+
+        w = TestApp(self.app, cookiejar=IndexedCookieJar(max_headers=4))
+        w.get('/sess/save')
+        for i in range(10):
+            r = w.get('/missing/%i/' % i, status=404)
+            self.assertIn('session=', r.request.headers['Cookie'])
+        self.assertEqual(len(w.cookiejar._headers), 4)
+
     def test_init(self):
         w = TestApp(self.app)
         self.assertEqual(w.get('/').status_code, 200)
@@ -65,6 +236,443 @@ class TestMainFeatures(unittest.TestCase):
         finally:
             self.app.config['SERVER_NAME'] = original_server_name
 
+    def test_signals_connected_once(self):
+        w2 = TestApp(self.app)
+        r = self.w.get('/')
+        self.assertEqual(len(r.contexts), 1)
+        r = w2.get('/').form.submit()
+        self.assertEqual(len(r.contexts), 2)
+        self.assertEqual(len(r.flashes), 2)
+
+        w2.close()
+        r = w2.get('/')
+        self.assertFalse(r.contexts)
+        r = self.w.get('/')
+        self.assertEqual(len(r.contexts), 1)
+
+    def test_signals_disconnected_on_gc(self):
+        gc.collect()
+        receivers = len(template_rendered.receivers)
+        w = TestApp(self.app)
+        self.assertEqual(len(template_rendered.receivers), receivers + 1)
+        del w
+        gc.collect()
+        self.assertEqual(len(template_rendered.receivers), receivers)
+
+    def test_capture_modes(self):
+        w = TestApp(self.app, capture=CAPTURE_NONE)
+        r = w.get('/').form.submit()
+        self.assertFalse(r.contexts)
+        self.assertFalse(r.flashes)
+        self.assertEqual(r.session, {})
+
+        r = w.get('/').form.submit(capture=CAPTURE_NAMES)
+        self.assertEqual(r.contexts, {
+            'template.html': None,
+            'extra-template.html': None,
+        })
+        self.assertEqual(len(r.flashes), 2)
+
+        r = w.get('/', capture=CAPTURE_FULL)
+        self.assertEqual(r.context['text'], 'Hello!')
+
+        with self.assertRaises(AssertionError):
+            w.get('/', capture='everything')
+
+    def test_session_copied_lazily(self):
+        self.w.get('/sess/save')
+        r = self.w.get('/whoami/')
+        self.assertIsNone(r._session)
+        self.assertEqual(r.session, {'foo': 'bar'})
+        self.assertIs(r.session, r.session)
+
+    def test_context_capture_strategies(self):
+        r = self.w.get('/', context_capture=CONTEXT_COPY)
+        self.assertIs(type(r.context), dict)
+        self.assertEqual(r.context['text'], 'Hello!')
+
+        r = self.w.get('/', context_capture=CONTEXT_WEAKREF)
+        self.assertIsInstance(r.context, WeakContext)
+        self.assertEqual(r.context['text'], 'Hello!')
+        self.assertIn('request', r.context)
+
+        r = self.w.get('/', context_capture=CONTEXT_SUMMARY)
+        self.assertEqual(r.context['text'], ValueSummary('str', 6))
+
+    def test_context_budget(self):
+        w = TestApp(self.app, max_context_items=1)
+        with self.assertRaises(ContextBudgetExceeded) as cm:
+            w.get('/')
+        self.assertIn('template.html', str(cm.exception))
+
+        r = w.get('/', max_context_items=None, max_context_bytes=10 ** 6)
+        self.assertEqual(r.context['text'], 'Hello!')
+        with self.assertRaises(ContextBudgetExceeded):
+            w.get('/', max_context_items=None, max_context_bytes=1)
+
+    def test_concurrent_requests(self):
+        def request(i):
+            if i % 2:
+                return 2, self.w.get('/').form.submit()
+            return 1, self.w.get('/')
+
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            results = list(pool.map(request, range(64)))
+        for templates, r in results:
+            self.assertEqual(len(r.contexts), templates)
+            self.assertEqual(len(r.flashes), 2 if templates == 2 else 0)
+        # Which response stored the session cookie last depends on the order
+        # the requests finished in, but they all shared the same jar.
+        self.w.get('/sess/save')
+        self.assertEqual(len(self.w.cookiejar), 1)
+        self.assertEqual(self.w.get('/sess/get').text, 'rikerbar')
+
+    def test_batch(self):
+        specs = [
+            '/',
+            {'url': '/', 'method': 'post', 'capture': CAPTURE_NAMES},
+            {'url': '/sess/save'},
+            {'url': '/whoami/', 'headers': {'X-Test': '1'}},
+            {'url': '/missing/', 'status': 404},
+            {'url': '/missing/%C3%A9%20/', 'status': 404},
+        ]
+        responses = list(self.w.batch(specs, headers={'Accept': 'text/html'},
+                                      capture=CAPTURE_FULL))
+        self.assertEqual([r.status_int for r in responses], [200, 200, 200, 200, 404, 404])
+        self.assertEqual(responses[5].request.path_info,
+                         self.w.get('/missing/%C3%A9%20/', status=404).request.path_info)
+        self.assertEqual(responses[0].context['text'], 'Hello!')
+        self.assertEqual(responses[1].contexts['template.html'], None)
+        self.assertEqual(len(responses[1].flashes), 2)
+        self.assertEqual(responses[3].session['foo'], 'bar')
+        self.assertEqual(responses[3].request.headers['Accept'], 'text/html')
+        self.assertEqual(responses[3].request.headers['X-Test'], '1')
+
+    def test_batch_workers(self):
+        specs = ['/?i=%i' % i for i in range(20)]
+        responses = list(self.w.batch(specs, workers=4))
+        self.assertEqual([r.request.GET['i'] for r in responses],
+                         [str(i) for i in range(20)])
+        self.assertTrue(all(r.template == 'template.html' for r in responses))
+
+    def test_timings(self):
+        r = self.w.get('/').form.submit()
+        timings = r.timings
+        self.assertEqual([name for name, _ in timings.templates],
+                         ['extra-template.html', 'template.html'])
+        self.assertTrue(all(duration > 0 for _, duration in timings.templates))
+        self.assertGreater(timings.request, sum(d for _, d in timings.templates))
+        self.assertGreater(timings.wsgi, timings.request)
+        self.assertGreater(timings.total, timings.wsgi)
+        self.assertGreater(timings.capture, 0)
+
+        r = self.w.get('/', capture=CAPTURE_NONE)
+        self.assertIsNone(r.timings.request)
+        self.assertEqual(r.timings.templates, [])
+        self.assertGreater(r.timings.total, r.timings.wsgi)
+
+    def test_trace_memory(self):
+        self.assertIsNone(self.w.get('/').memory)
+
+        w = TestApp(self.app, trace_memory=True)
+        memory = w.get('/memory/10000/').memory
+        self.assertGreater(memory.peak, memory.net)
+        self.assertGreater(memory.net, 0)
+        self.assertLessEqual(len(memory.top), 10)
+        self.assertIn('core.py', memory.top[0].location)
+        self.assertGreater(memory.top[0].size, 0)
+
+        memory = self.w.get('/memory/10/', trace_memory=1).memory
+        self.assertEqual(len(memory.top), 1)
+
+        # Overlapping traces (e.g. of concurrent requests) share tracing,
+        # it's stopped when the last one exits
+        first, second = AllocationTrace(), AllocationTrace(top_limit=1)
+        first.__enter__()
+        second.__enter__()
+        first.__exit__(None, None, None)
+        self.assertTrue(tracemalloc.is_tracing())
+        second.__exit__(None, None, None)
+        self.assertEqual(len(second.top), 1)
+        self.assertFalse(tracemalloc.is_tracing())
+        # The peak of overlapping traces can't be measured and isn't checked
+        self.assertIsNone(first.peak)
+        self.assertIsNone(second.peak)
+        with AllocationTrace() as third:
+            pass
+        self.assertIsNotNone(third.peak)
+        Budget(max_alloc_kb=0).check(self.w.get('/'), first.peak)
+
+    def test_trace_recorder(self):
+        recorder = TraceRecorder()
+        w = recorder.attach(TestApp(self.app))
+        with w.session_transaction() as sess:
+            sess['foo'] = 'bar'
+        w.post('/')
+        w.get('/', capture=CAPTURE_NONE)
+
+        events = recorder.to_json()['traceEvents']
+        names = [event['name'] for event in events]
+        self.assertEqual(names.count('session_transaction'), 1)
+        self.assertEqual(names.count('POST /'), 1)
+        self.assertEqual(names.count('GET /'), 1)
+        self.assertEqual(names.count('template.html'), 2)
+        self.assertEqual(names.count('extra-template.html'), 1)
+        self.assertIn('capture session', names)
+
+        post = events[names.index('POST /')]
+        self.assertEqual(post['ph'], 'X')
+        self.assertEqual(post['args']['status'], 200)
+        # Spans of the POST request are recorded before it ends
+        for event in events[names.index('session_transaction') + 1:names.index('POST /')]:
+            self.assertIn(event['cat'], ('template', 'capture'))
+            self.assertGreaterEqual(event['ts'], post['ts'])
+            self.assertLessEqual(event['ts'] + event['dur'], post['ts'] + post['dur'])
+
+        fd, path = tempfile.mkstemp(suffix='.json')
+        os.close(fd)
+        try:
+            recorder.save(path)
+            with open(path) as fo:
+                self.assertEqual(len(json.load(fo)['traceEvents']), len(events))
+        finally:
+            os.remove(path)
+
+    def test_endpoint_report(self):
+        report = EndpointReport()
+        w = TestApp(self.app, report=report, capture=CAPTURE_NONE)
+        for _ in range(3):
+            w.get('/whoami/')
+        w.post('/')
+        w.get('/nope/', status=404)
+
+        stats = report.stats
+        self.assertEqual(sorted(stats), ['GET /whoami/', 'GET <unmatched>', 'POST /'])
+        whoami = stats['GET /whoami/']
+        self.assertEqual(whoami.endpoint, 'whoami')
+        self.assertEqual(whoami.hits, 3)
+        self.assertLessEqual(whoami.p50, whoami.p95)
+        self.assertLessEqual(whoami.p95, whoami.max)
+        self.assertGreater(whoami.mean_bytes, 0)
+        self.assertIsNone(whoami.mean_queries)
+        self.assertIsNone(stats['GET <unmatched>'].endpoint)
+
+        self.assertEqual(report.to_json()['POST /']['hits'], 1)
+        table = report.format_table().splitlines()
+        self.assertTrue(table[0].startswith('endpoint'))
+        self.assertEqual(len(table), 4)
+
+        # Instances without a report only report to the enabled default report
+        self.w.get('/whoami/')
+        self.assertEqual(whoami.hits, 3)
+
+    @unittest.skipUnless(hasattr(os, 'fork'), 'requires os.fork')
+    def test_fork_runner(self):
+        def whoami(w, user):
+            previous = w.get('/whoami/').text
+            with w.session_transaction() as sess:
+                sess['username'] = user
+            return os.getpid(), previous
+
+        results = ForkRunner(self.app, workers=2).map(whoami, ['a', 'b', 'c'])
+        self.assertEqual(results[0][0], results[2][0])
+        self.assertNotEqual(results[0][0], results[1][0])
+        self.assertNotIn(os.getpid(), [pid for pid, _ in results])
+        # Every worker has a cookie jar of its own
+        self.assertEqual([previous for _, previous in results], ['nobody', 'nobody', 'a'])
+
+        runner = ForkRunner(self.app, workers=2)
+        with self.assertRaises(AppError):
+            runner.map(lambda w, url: w.get(url).status_int, ['/', '/nope/'])
+        with self.assertRaises(TypeError):
+            runner.map(lambda w, url: w.get(url), ['/'])
+
+    def test_parsed_body_cache(self):
+        r = self.w.get('/forms/')
+        self.assertIs(r.html, r.html)
+        self.assertIs(r.forms, r.forms)
+        html = r.html
+        r.body = r.body.replace(b'Anton', b'Petr')
+        self.assertIsNot(r.html, html)
+        self.assertEqual(r.forms['profile']['name'].value, 'Petr')
+
+        r = self.w.post_json('/json/', {'a': [1]})
+        self.assertEqual(r.json, {'a': [1]})
+        self.assertIs(r.json, r.json)
+
+    @unittest.skipIf(lxml is None, 'requires lxml')
+    def test_lxml_backend(self):
+        def fields(form):
+            return [(name, field.__class__, field.value) for name, field in form.field_order]
+
+        r = self.w.get('/forms/')
+        lxml_r = TestApp(self.app, html_backend=HTML_LXML).get('/forms/')
+        self.assertEqual(list(lxml_r.forms), [0, 'profile', 1])
+        form = lxml_r.forms['profile']
+        self.assertIsInstance(form, LxmlForm)
+        self.assertEqual(fields(form), [
+            ('name', webtest_forms.Text, 'Anton'),
+            ('admin', webtest_forms.Checkbox, '1'),
+            ('color', webtest_forms.Radio, 'green'),
+            ('language', webtest_forms.Select, 'ru'),
+            ('about', webtest_forms.Text, 'Hello, world!'),
+            ('save', webtest_forms.Submit, None),
+            # Associated using the `form` attribute
+            ('token', webtest_forms.Hidden, 'abc'),
+        ])
+        self.assertEqual(fields(form)[:6], fields(r.forms['profile'])[:6])
+        self.assertEqual(fields(lxml_r.forms[1]), fields(r.forms[1]))
+        self.assertEqual(form['language'].options, r.forms['profile']['language'].options)
+        self.assertIs(lxml_r.lxml, lxml_r.lxml)
+
+        form['name'] = 'Petr'
+        form['language'] = 'en'
+        self.assertEqual(form.submit('save').text, 'about=Hello, world!, admin=1, color=green, '
+                                                   'language=en, name=Petr, save=1, token=abc')
+
+    def test_stream(self):
+        r = self.w.get('/stream/3/?name=Anton', stream=True)
+        self.assertIsInstance(r.stream, StreamedBody)
+        self.assertEqual([chunk.size for chunk in r.stream.chunks], [8, 8, 8])
+        self.assertEqual(list(r.stream), [b'0,Anton\n', b'1,Anton\n', b'2,Anton\n'])
+        self.assertEqual(r.stream.ttfb, r.stream.chunks[0].time)
+        self.assertEqual(r.timings.ttfb, r.stream.ttfb)
+        self.assertLessEqual(r.stream.chunks[0].time, r.stream.chunks[-1].time)
+        self.assertFalse(r.stream.spooled)
+        self.assertEqual(r.text, '0,Anton\n1,Anton\n2,Anton\n')
+        # Reading the whole body closes the temporary file
+        self.assertTrue(r.stream.file.closed)
+        self.assertEqual(r.session['streamed'], 3)
+        self.assertEqual(self.w.get('/whoami/').session['streamed'], 3)
+
+        r = self.w.get('/stream/1000/', stream=1024)
+        self.assertTrue(r.stream.spooled)
+        self.assertEqual(r.stream.size, sum(len(chunk) for chunk in r.stream))
+
+        self.assertIsNone(self.w.get('/stream/1/').stream)
+        self.assertIsNone(self.w.get('/stream/1/').timings.ttfb)
+        with self.assertRaises(AppError):
+            self.w.get('/nope/', stream=True)
+
+    def test_run_load(self):
+        scenario = ['/whoami/', {'url': '/', 'method': 'POST'}, '/nope/']
+        result = run_load(self.app, scenario, requests=10, workers=2)
+        self.assertEqual(result.requests, 10)
+        # Every worker starts with the first request of the scenario
+        self.assertEqual(result.errors, 2)
+        self.assertEqual(result.latencies, sorted(result.latencies))
+        self.assertLessEqual(result.percentile(50), result.percentile(99))
+        self.assertGreater(result.throughput, 0)
+        self.assertEqual(result.as_dict()['requests'], 10)
+        self.assertIn('throughput', result.format())
+
+        self.assertEqual(run_load(self.app, scenario, workers=2).requests, 6)
+        result = run_load(self.app, ['/whoami/'], duration=0.05)
+        self.assertGreater(result.requests, 1)
+        self.assertGreaterEqual(result.duration, 0.05)
+
+        # Requests that specify `status` are checked against it
+        scenario = [{'url': '/nope/', 'status': 404}, {'url': '/whoami/', 'status': 404}]
+        self.assertEqual(run_load(self.app, scenario, requests=4).errors, 2)
+
+    @unittest.skipUnless(hasattr(os, 'fork'), 'requires os.fork')
+    def test_run_load_processes(self):
+        result = run_load(self.app, ['/whoami/'], requests=5, workers=2, processes=True)
+        self.assertEqual((result.requests, result.errors), (5, 0))
+
+    def test_load_command(self):
+        with mock.patch('sys.stdout', new_callable=io.StringIO) as stdout:
+            code = main(['load', 'tests.core:app', '/whoami/', '/', '-n', '4', '--json'])
+        self.assertEqual(code, 0)
+        self.assertEqual(json.loads(stdout.getvalue())['requests'], 4)
+
+        with mock.patch('sys.stdout', new_callable=io.StringIO) as stdout:
+            code = main(['load', 'tests.core:app', '/nope/', '-H', 'Accept: text/html'])
+        self.assertEqual(code, 1)
+        self.assertIn('errors      1', stdout.getvalue())
+
+        with mock.patch('sys.stderr', new_callable=io.StringIO) as stderr:
+            with self.assertRaises(SystemExit):
+                main(['load', 'tests.core:app', '/', '-H', 'Accept'])
+        self.assertIn("invalid header 'Accept'", stderr.getvalue())
+
+    def test_traffic_replay(self):
+        with tempfile.TemporaryDirectory() as path:
+            path = os.path.join(path, 'traffic.jsonl')
+            recorder = TrafficRecorder(path)
+            w = recorder.attach(TestApp(self.app))
+            w.post('/', {'name': 'Anton'})
+            with w.session_transaction() as sess:
+                sess['username'] = 'Anton'
+            w.get('/whoami/')
+            w.post_json('/json/', {'a': [1]})
+            w.get('/nope/', status=404)
+            recorder.close()
+
+            records = list(read_traffic(path))
+            self.assertEqual([record['url'] for record in records],
+                             ['/', '/whoami/', '/json/', '/nope/'])
+            self.assertEqual(records[0]['body'], 'name=Anton')
+            self.assertEqual(records[0]['templates'], ['extra-template.html', 'template.html'])
+            self.assertEqual(records[1]['session']['username'], 'Anton')
+            self.assertEqual(records[1]['response_body'], 'Anton')
+            self.assertNotIn('body', records[1])
+            self.assertEqual(records[3]['status'], 404)
+
+            report = replay_traffic(self.app, path)
+            self.assertEqual(len(report.requests), 4)
+            self.assertEqual(report.mismatches, [])
+            self.assertGreater(report.requests[1].slowdown, 0)
+            self.assertIn('0 with differences', report.format(timings=True))
+
+            records[1]['response_body'] = 'Petr'
+            records[2]['status'] = 201
+            report = replay_traffic(self.app, records)
+            self.assertEqual([request.differences for request in report.mismatches],
+                             [[('body', b'Petr', b'Anton')], [('status', 201, 200)]])
+
+            with mock.patch('sys.stdout', new_callable=io.StringIO) as stdout:
+                self.assertEqual(main(['replay', 'tests.core:app', path]), 0)
+            self.assertIn('4 requests replayed', stdout.getvalue())
+
+    def test_response_cache(self):
+        version = [0]
+        cache = ResponseCache(state_version=lambda: version[0])
+        w = TestApp(self.app, response_cache=cache)
+        r1 = w.get('/')
+        r2 = w.get('/')
+        self.assertFalse(r1.from_cache)
+        self.assertTrue(r2.from_cache)
+        self.assertEqual(r2.text, r1.text)
+        self.assertEqual(r2.template, 'template.html')
+        self.assertEqual(r2.context['text'], 'Hello!')
+        self.assertEqual(r2.flashes, r1.flashes)
+        self.assertIsNot(r2.contexts, r1.contexts)
+        self.assertEqual(cache.stats(), {'hits': 1, 'misses': 1, 'entries': 1})
+
+        # Different headers, cookies and state versions are cached separately
+        self.assertFalse(w.get('/', headers={'Accept': 'text/plain'}).from_cache)
+        with w.session_transaction() as sess:
+            sess['username'] = 'Anton'
+        self.assertFalse(w.get('/whoami/').from_cache)
+        r = w.get('/whoami/')
+        self.assertTrue(r.from_cache)
+        self.assertEqual(r.session['username'], 'Anton')
+        version[0] += 1
+        self.assertFalse(w.get('/whoami/').from_cache)
+
+        self.assertFalse(w.get('/whoami/', cache=False).from_cache)
+        self.assertTrue(w.get('/whoami/').from_cache)
+        with self.assertRaises(AppError):
+            w.get('/whoami/', status=404)
+        self.assertFalse(w.post('/').from_cache)
+        # The session cookie has changed
+        self.assertFalse(w.get('/whoami/').from_cache)
+
+        cache.invalidate()
+        self.assertEqual(cache.stats()['entries'], 0)
+        self.assertFalse(w.get('/whoami/').from_cache)
+
     def test_localhost_session_transaction(self):
         ta = TestApp(self.app)
         resp = ta.get('/sess/save')
@@ -87,6 +695,67 @@ class TestMainFeatures(unittest.TestCase):
         resp = ta.get('/sess/get')
         assert resp.text == 'enterprisebar', resp.text
 
+
+class TestAsync(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.w = AsyncTestApp(app1)
+
+    @unittest.skipUnless(asgiref is not None and int(flask_version.split('.')[0]) >= 2,
+                         'async views require Flask 2.0 and asgiref')
+    async def test_concurrent_requests(self):
+        delays = [5, 1, 4, 0, 3, 2] * 4
+        responses = await asyncio.gather(*[
+            self.w.aget('/async/%i/' % delay) for delay in delays
+        ])
+        for delay, r in zip(delays, responses):
+            self.assertEqual(r.context['text'], str(delay))
+            self.assertEqual(r.flashes, [('message', 'Waited %i ms' % delay)])
+
+    async def test_request_options_and_helpers(self):
+        r = await self.w.aget('/', capture=CAPTURE_NAMES)
+        self.assertEqual(r.contexts, {'template.html': None})
+
+        r = await self.w.arun(r.form.submit)
+        self.assertEqual(len(r.contexts), 2)
+
+        await self.w.aget('/sess/save')
+        r = await self.w.aget('/sess/get')
+        self.assertEqual(r.session['foo'], 'bar')
+
+
+class TestAsyncSessionScopes(unittest.IsolatedAsyncioTestCase):
+    # Before Python 3.11 setUp doesn't run in the context of test methods
+    async def asyncSetUp(self):
+        self.app_context = app2.app_context()
+        self.app_context.push()
+
+    async def asyncTearDown(self):
+        self.app_context.pop()
+
+    async def test_scopes_in_tasks(self):
+        outer_session = db.session()
+
+        async def session_in_scope():
+            with SessionScope(db):
+                session = db.session()
+                await asyncio.sleep(0)
+                self.assertIs(db.session(), session)
+                return session
+
+        sessions = await asyncio.gather(*[session_in_scope() for _ in range(3)])
+        self.assertEqual(len(set(map(id, sessions))), 3)
+        self.assertNotIn(outer_session, sessions)
+        self.assertIs(db.session(), outer_session)
+
+        async def current_session():
+            return db.session()
+
+        with SessionScope(db):
+            # Tasks inherit the scope they're created in
+            scoped_session = db.session()
+            self.assertIs(await asyncio.create_task(current_session()), scoped_session)
+
+
 class TestSQLAlchemyFeatures(unittest.TestCase):
     def setUp(self):
         self.app = app2
@@ -118,6 +787,271 @@ class TestSQLAlchemyFeatures(unittest.TestCase):
         r = self.w.get('/user/%i/' % user.id)
         self.assertEqual(r.body.decode('utf-8'), 'Hello, Anton!')
 
+    def test_concurrent_session_scopes(self):
+        user = User(name='Anton')
+        db.session.add(user)
+        db.session.commit()
+        user_id = user.id
+        user.name = 'Petr'
+
+        def request(i):
+            return self.w.get('/user/%i/' % user_id).body.decode('utf-8')
+
+        with ThreadPoolExecutor(max_workers=4) as pool:
+            bodies = set(pool.map(request, range(16)))
+        self.assertEqual(bodies, {'Hello, Anton!'})
+
+    @unittest.skipUnless(SessionScope.transactions_supported, 'requires SQLAlchemy 2.0')
+    def test_transactional_scope(self):
+        db.session.add(User(name='Anton'))
+        db.session.commit()
+
+        with SessionScope(db, transactional=True):
+            db.session.add(User(name='Petr'))
+            db.session.commit()
+            self.w.post('/user/', {'name': 'Ivan'})
+            self.w.post('/user/', {'name': 'Oleg'})
+            r = self.w.get('/users/')
+            self.assertEqual(r.body.decode('utf-8'), 'Anton, Petr, Ivan, Oleg')
+            self.assertEqual(db.session.query(User).count(), 4)
+
+            # Requests performed by several threads share the scope's connection
+            specs = [{'url': '/user/', 'method': 'post', 'params': {'name': 'User %i' % i}}
+                     for i in range(16)]
+            for w in (self.w, self.w_without_scoping):
+                self.assertEqual(len(list(w.batch(specs, workers=4))), 16)
+            self.assertEqual(db.session.query(User).count(), 36)
+
+        r = self.w.get('/users/')
+        self.assertEqual(r.body.decode('utf-8'), 'Anton')
+        self.assertEqual(db.session.query(User).count(), 1)
+
+        self.w.post('/user/', {'name': 'Ivan'})
+        r = self.w.get('/users/')
+        self.assertEqual(r.body.decode('utf-8'), 'Anton, Ivan')
+
+    @unittest.skipUnless(SessionScope.transactions_supported and hasattr(type(db), 'engines'),
+                         'requires SQLAlchemy 2.0 and Flask-SQLAlchemy 3.0')
+    def test_transactional_scope_leaves_engines_alone(self):
+        with tempfile.TemporaryDirectory() as path:
+            engine = sqlalchemy.create_engine('sqlite:///%s/test.db' % path)
+            engines = db.engines
+            original, engines[None] = engines[None], engine
+            try:
+                db.create_all()
+                with SessionScope(db, transactional=True):
+                    self.w.post('/user/', {'name': 'Anton'})
+                    self.assertEqual(db.session.query(User).count(), 1)
+                    self.assertIs(db.engine, engine)
+                    self.assertNotIn('join_transaction_mode', db.session.session_factory.kw)
+                    # Connections made outside of the scope's sessions
+                    # don't see its transaction
+                    with db.engine.connect() as connection:
+                        count = connection.execute(sqlalchemy.text('SELECT count(*) FROM user'))
+                        self.assertEqual(count.scalar(), 0)
+                    self.assertEqual(db.session.query(User).count(), 1)
+                self.assertEqual(db.session.query(User).count(), 0)
+            finally:
+                db.session.remove()
+                engine.dispose()
+                engines[None] = original
+
+    def test_queries(self):
+        for name in ('Anton', 'Petr', 'Ivan'):
+            db.session.add(User(name=name))
+        db.session.commit()
+
+        r = self.w.get('/users/one-by-one/')
+        self.assertEqual(r.body.decode('utf-8'), 'Anton, Petr, Ivan')
+        self.assertEqual(len(r.queries), 4)
+        query = r.queries[1]
+        self.assertIn('FROM user', query.statement)
+        self.assertEqual(query.parameters, (1,))
+        self.assertGreater(query.duration, 0)
+        self.assertIn('core_sqlalchemy.py', query.location)
+
+        repeated = r.repeated_queries()
+        self.assertEqual(len(repeated), 1)
+        shape, queries = repeated[0]
+        self.assertEqual(len(queries), 3)
+        self.assertEqual(r.repeated_queries(min_count=4), [])
+
+        r = self.w.get('/users/', record_queries=False)
+        self.assertEqual(r.queries, [])
+        self.assertEqual(self.w_without_scoping.get('/users/').queries, [])
+
+    @unittest.skipUnless(hasattr(os, 'fork'), 'requires os.fork')
+    def test_fork_runner(self):
+        db.session.add(User(name='Anton'))
+        db.session.commit()
+
+        def create(w, name):
+            w.post('/user/', {'name': name})
+            return w.get('/users/').text
+
+        runner = ForkRunner(self.app, db=db, workers=2)
+        self.assertEqual(runner.map(create, ['Petr', 'Ivan', 'Oleg']),
+                         ['Anton, Petr', 'Anton, Ivan', 'Anton, Petr, Oleg'])
+        self.assertEqual(db.session.query(User).count(), 1)
+
+    @unittest.skipUnless(hasattr(os, 'fork'), 'requires os.fork')
+    def test_fork_runner_database_file(self):
+        def create(w, name):
+            options = db.engine.get_execution_options()
+            return w.post('/user/', {'name': name}).text, options.get('test_option')
+
+        with tempfile.TemporaryDirectory() as path:
+            url = 'sqlite:///%s/test.db' % path
+            if hasattr(type(db), 'engines'):
+                engine = sqlalchemy.create_engine(url, execution_options={'test_option': 1})
+                engines = db.engines
+                original, engines[None] = engines[None], engine
+            else:
+                # Flask-SQLAlchemy 2.x creates the engine when the URI changes
+                config = mock.patch.dict(self.app.config, {
+                    'SQLALCHEMY_DATABASE_URI': url,
+                    'SQLALCHEMY_ENGINE_OPTIONS': {'execution_options': {'test_option': 1}},
+                })
+                config.start()
+                engine = db.get_engine(self.app)
+            try:
+                db.create_all()
+                runner = ForkRunner(self.app, db=db, workers=2)
+                self.assertEqual(runner.map(create, ['Anton', 'Petr', 'Ivan']),
+                                 [('1', 1), ('1', 1), ('2', 1)])
+                self.assertEqual(db.session.query(User).count(), 0)
+                self.assertEqual(os.listdir(path), ['test.db'])
+            finally:
+                db.session.remove()
+                engine.dispose()
+                if hasattr(type(db), 'engines'):
+                    engines[None] = original
+                else:
+                    config.stop()
+
+    def test_response_cache(self):
+        cache = ResponseCache()
+        w = TestApp(self.app, db=db, use_session_scopes=True, response_cache=cache)
+        self.assertEqual(w.get('/users/').text, '')
+        self.assertTrue(w.get('/users/').from_cache)
+
+        # Commits made by views and tests invalidate cached responses
+        w.post('/user/', {'name': 'Anton'})
+        self.assertEqual(w.get('/users/').text, 'Anton')
+        db.session.add(User(name='Petr'))
+        db.session.commit()
+        self.assertEqual(w.get('/users/').text, 'Anton, Petr')
+        self.assertTrue(w.get('/users/').from_cache)
+
+        # Including Core statements executed through the session
+        db.session.execute(sqlalchemy.insert(User).values(name='Ivan'))
+        db.session.commit()
+        self.assertEqual(w.get('/users/').text, 'Anton, Petr, Ivan')
+        db.session.execute(sqlalchemy.delete(User).where(User.name == 'Ivan'))
+        db.session.commit()
+        self.assertEqual(w.get('/users/').text, 'Anton, Petr')
+
+        # Reads don't
+        db.session.query(User).all()
+        db.session.execute(sqlalchemy.select(User))
+        db.session.commit()
+        self.assertTrue(w.get('/users/').from_cache)
+
+        # Stale responses are dropped
+        for name in ['Ivan', 'Oleg', 'Pavel']:
+            db.session.add(User(name=name))
+            db.session.commit()
+            self.assertFalse(w.get('/users/').from_cache)
+            self.assertEqual(cache.stats()['entries'], 1)
+        db.session.query(User).filter(User.name.in_(['Ivan', 'Oleg', 'Pavel'])).delete()
+        db.session.commit()
+
+        if not SessionScope.transactions_supported:
+            return
+        scope = SessionScope(db, transactional=True)
+        scope.push()
+        w.post('/user/', {'name': 'Ivan'})
+        self.assertEqual(w.get('/users/').text, 'Anton, Petr, Ivan')
+        scope.pop()
+        self.assertEqual(w.get('/users/').text, 'Anton, Petr')
+
+    def test_scopefunc(self):
+        scopefunc = db.session.registry.scopefunc
+        outer_key = scopefunc()
+        outer_session = db.session()
+        with SessionScope(db) as scope:
+            key = scopefunc()
+            self.assertIs(scopefunc(), key)
+            session = db.session()
+            self.assertIsNot(session, outer_session)
+            with SessionScope(db):
+                self.assertNotEqual(scopefunc(), key)
+            self.assertIs(scopefunc(), key)
+            self.assertIs(db.session(), session)
+        self.assertEqual(scopefunc(), outer_key)
+        self.assertIs(db.session(), outer_session)
+        self.assertEqual(scope._keys, {})
+
+        # Only the innermost scope can be popped
+        scope = SessionScope(db)
+        scope.push()
+        self.assertRaises(AssertionError, SessionScope(db).pop)
+        scope.pop()
+
+    def test_session_scopes_in_threads(self):
+        def session_in_scope(i):
+            with self.app.app_context(), SessionScope(db):
+                return id(db.session()), db.session.query(User).count()
+
+        with SessionScope(db):
+            session = db.session()
+            with ThreadPoolExecutor(max_workers=4) as pool:
+                results = list(pool.map(session_in_scope, range(4)))
+            self.assertIs(db.session(), session)
+        self.assertNotIn(id(session), [id_ for id_, _ in results])
+        self.assertEqual([count for _, count in results], [0] * 4)
+
+    def test_endpoint_report_queries(self):
+        db.session.add(User(name='Anton'))
+        db.session.commit()
+
+        report = EndpointReport()
+        w = TestApp(self.app, db=db, use_session_scopes=True, report=report)
+        w.get('/users/one-by-one/')
+        w.get('/users/one-by-one/', record_queries=False)
+        self.assertEqual(report.stats['GET /users/one-by-one/'].mean_queries, 2)
+
+    def test_budget(self):
+        for name in ('Anton', 'Petr', 'Ivan'):
+            db.session.add(User(name=name))
+        db.session.commit()
+
+        self.w.get('/users/one-by-one/', budget={'max_queries': 4})
+        with self.assertRaises(BudgetExceeded) as cm:
+            self.w.get('/users/one-by-one/', budget=Budget(max_queries=3))
+        message = str(cm.exception)
+        self.assertIn('GET /users/one-by-one/ exceeded its budget: 4 queries (max 3)', message)
+        self.assertIn('3x SELECT', message)
+
+        with self.w.budget(max_queries=1, max_ms=10 ** 4, max_alloc_kb=10 ** 4):
+            self.w.get('/users/')
+            self.w_without_scoping.get('/users/one-by-one/')
+            with self.assertRaises(BudgetExceeded):
+                self.w.get('/users/one-by-one/')
+            self.w.get('/users/one-by-one/', budget=None)
+            with self.assertRaises(BudgetExceeded) as cm:
+                self.w.get('/users/', budget={'max_alloc_kb': 0, 'max_ms': 0})
+        self.assertIn('KiB allocated (max 0)', str(cm.exception))
+        self.assertIn('ms (max 0)', str(cm.exception))
+        self.w.get('/users/one-by-one/')
+
+    def test_statement_shape(self):
+        self.assertEqual(
+            statement_shape("SELECT *\n  FROM t WHERE a = 'x' AND b IN (1, 2, 3) AND c = :c"),
+            'SELECT * FROM t WHERE a = ? AND b IN (?) AND c = ?')
+        self.assertEqual(statement_shape('SELECT x::int FROM t1 WHERE y = %(y)s'),
+                         'SELECT x::int FROM t1 WHERE y = ?')
+
     def test_2(self):
         user = User(name='Anton')
         db.session.add(user)
@@ -141,10 +1075,73 @@ class TestSQLAlchemyFeatures(unittest.TestCase):
             lambda: db.session.refresh(user))
 
 
+class TestPytestPlugin(unittest.TestCase):
+    def run_pytest(self, files, *args):
+        with tempfile.TemporaryDirectory() as path:
+            for name, content in files.items():
+                with open(os.path.join(path, name), 'w') as fo:
+                    fo.write(textwrap.dedent(content))
+            root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+            env = dict(os.environ, PYTHONPATH=root, PYTEST_DISABLE_PLUGIN_AUTOLOAD='1')
+            return subprocess.run(
+                [sys.executable, '-m', 'pytest', '-p', 'pytest_flask_webtest', '-q'] + list(args),
+                cwd=path, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                universal_newlines=True)
+
+    def test_fixtures(self):
+        result = self.run_pytest({
+            'pytest.ini': """
+                [pytest]
+                flask_webtest_app = tests.core_sqlalchemy:app
+                flask_webtest_db = tests.core_sqlalchemy:db
+                flask_webtest_database_uri = sqlite:///{worker}.db
+            """,
+            'test_app.py': """
+                import os
+
+                import pytest
+
+                from tests.core_sqlalchemy import db, User
+
+                DATABASE_URI = os.environ['FLASK_SQLALCHEMY_DATABASE_URI']
+
+
+                @pytest.mark.parametrize('name', ['Anton', 'Petr'])
+                def test_create(testapp, name):
+                    assert not testapp.cookies
+                    testapp.post('/user/', {'name': name})
+                    # Everything written by the previous test is rolled back
+                    assert testapp.get('/users/').text == name
+                    assert db.session.query(User).count() == 1
+
+
+                def test_cached(flask_app, testapp):
+                    assert testapp.app is flask_app
+
+
+                def test_database_uri():
+                    # Exported before test modules are imported
+                    assert DATABASE_URI == 'sqlite:///master.db'
+            """,
+        }, '--flask-webtest-report')
+        self.assertEqual(result.returncode, 0, result.stdout)
+        self.assertIn('4 passed', result.stdout)
+        self.assertIn('flask-webtest endpoint report', result.stdout)
+        self.assertIn('POST /user/', result.stdout)
+
+    def test_missing_app(self):
+        result = self.run_pytest({'test_app.py': 'def test(testapp):\n    pass\n'})
+        self.assertNotEqual(result.returncode, 0)
+        self.assertIn('flask_webtest_app', result.stdout)
+
+
 def suite():
     suite = unittest.TestSuite()
     suite.addTest(unittest.makeSuite(TestMainFeatures))
+    suite.addTest(unittest.makeSuite(TestAsync))
+    suite.addTest(unittest.makeSuite(TestAsyncSessionScopes))
     suite.addTest(unittest.makeSuite(TestSQLAlchemyFeatures))
+    suite.addTest(unittest.makeSuite(TestPytestPlugin))
     return suite
 
 